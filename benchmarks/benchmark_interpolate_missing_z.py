@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark of the algorithm interpolating missing Z values on a line Z layer.
+
+Synthetic line Z datasets are generated with controlled parameters (number
+of lines, vertices per line, ratio of missing Z values, length of the gaps,
+frequency of the missing ends, ratio of multipart lines). The stages of the
+interpolation are timed separately:
+- the pure helpers (no QGIS object involved), from the WKB of the lines,
+- the legacy algorithm (fill_list_ends() and the loop calling interpolate_z()
+  for each missing vertex), on the same lines,
+- the stages involving QGIS (reading the features, building the geometries,
+  writing to a sink) and the whole algorithm, run in a headless QgsApplication,
+  along with the stages timed by the algorithm itself (its TIMINGS output).
+  These are skipped with --no-qgis.
+
+The results are written as JSON, and can be compared to the ones of a
+previous run with --compare to catch regressions.
+
+It must be run with a Python interpreter that can import the QGIS libraries
+(eg. the OSGeo4W shell or python3 with python3-qgis installed):
+
+    python benchmarks/benchmark_interpolate_missing_z.py --lines 10000 --output bench.json
+    python benchmarks/benchmark_interpolate_missing_z.py --compare bench.json
+
+License: MIT
+"""
+
+import argparse
+import itertools
+import json
+import math
+import platform
+import struct
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+# The algorithm is a standalone script, not an installed package.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import interpolate_missing_z_on_line as imz  # noqa: E402
+
+NODATAZ = 0.
+
+
+### SYNTHETIC DATA
+
+def generate_line_z(rng, n_vertices, missing_ratio, mean_gap_length, end_gap):
+    """Generate the coordinates of a random line Z with gaps of missing values.
+
+    Parameters
+    ----------
+    rng : numpy.random.Generator
+        Random generator.
+    n_vertices : int
+        Number of vertices of the line.
+    missing_ratio : float
+        Approximate ratio of vertices with a missing Z value.
+    mean_gap_length : float
+        Mean number of consecutive vertices with a missing Z value (geometric distribution).
+    end_gap : bool
+        Whether the first and last vertices have missing Z values.
+
+    Returns
+    -------
+    numpy.ndarray
+        (n_vertices, 3) coordinates, the missing Z values being NODATAZ.
+    """
+    steps = rng.normal(size=(n_vertices, 2))
+    coords = np.empty((n_vertices, 3))
+    coords[:, :2] = np.cumsum(steps, axis=0)
+    coords[:, 2] = 100 + np.cumsum(rng.normal(scale=0.1, size=n_vertices))
+    missing = np.zeros(n_vertices, dtype=bool)
+    # The gaps are drawn among the interior vertices only, so at most all of
+    # them can be missing.
+    n_missing_target = min(int(missing_ratio * n_vertices), max(n_vertices - 2, 0))
+    while missing.sum() < n_missing_target:
+        gap_length = rng.geometric(1 / mean_gap_length)
+        start = rng.integers(1, n_vertices - 1)
+        missing[start:min(start + gap_length, n_vertices - 1)] = True
+    # The ends are only missing when asked to.
+    missing[0] = missing[-1] = end_gap
+    if missing.all():
+        missing[n_vertices // 2] = False
+    coords[missing, 2] = NODATAZ
+    return coords
+
+
+def line_z_wkb(parts):
+    """Return the WKB of a LineStringZ (one part) or a MultiLineStringZ."""
+    part_wkbs = [
+        struct.pack('<BII', 1, 1002, len(coords)) + coords.astype('<f8').tobytes()
+        for coords in parts
+    ]
+    if len(part_wkbs) == 1:
+        return part_wkbs[0]
+    return struct.pack('<BII', 1, 1005, len(part_wkbs)) + b''.join(part_wkbs)
+
+
+def generate_dataset(n_lines, n_vertices, missing_ratio, mean_gap_length, end_gap_ratio,
+                     multipart_ratio, seed):
+    """Generate the WKB of synthetic line Z features.
+
+    Returns
+    -------
+    list
+        WKB (bytes) of each line, with two parts for the multipart ones.
+    """
+    rng = np.random.default_rng(seed)
+    wkbs = []
+    for _ in range(n_lines):
+        n_parts = 2 if rng.random() < multipart_ratio else 1
+        parts = [
+            generate_line_z(
+                rng, max(n_vertices // n_parts, 2), missing_ratio, mean_gap_length,
+                rng.random() < end_gap_ratio
+            )
+            for _ in range(n_parts)
+        ]
+        wkbs.append(line_z_wkb(parts))
+    return wkbs
+
+
+### LEGACY ALGORITHM
+
+def legacy_distances(x, y):
+    """Return the distance of each vertex from the first one, computed like the legacy algorithm."""
+    seg_lengths = [
+        math.sqrt((x_j - x_i) ** 2 + (y_j - y_i) ** 2)
+        for x_i, y_i, x_j, y_j in zip(x[:-1], y[:-1], x[1:], y[1:])
+    ]
+    return [0] + list(itertools.accumulate(seg_lengths))
+
+
+def legacy_interpolate_gaps(z_values, dist, nodataz):
+    """Interpolate the gaps of a line whose ends are valid, one vertex at a time.
+
+    This is the loop of the legacy algorithm: the valid vertex after each
+    gap is searched forward, and interpolate_z() is called for each missing vertex.
+    """
+    new_zs = []
+    end_interp_idx = 0
+    for vert_idx, (current_dist, current_z) in enumerate(zip(dist, z_values)):
+        if current_z != nodataz:
+            start_interp_z = current_z
+            start_interp_dist = current_dist
+            new_z = current_z
+        else:
+            if vert_idx >= end_interp_idx:
+                end_interp_idx = vert_idx + 1
+                while z_values[end_interp_idx] == nodataz:
+                    end_interp_idx += 1
+                end_interp_z = z_values[end_interp_idx]
+                end_interp_dist = dist[end_interp_idx]
+            new_z = imz.interpolate_z(
+                current_dist, start_interp_dist, end_interp_dist, start_interp_z, end_interp_z
+            )
+        new_zs.append(new_z)
+    return new_zs
+
+
+def legacy_interpolate_line(x, y, z_values, nodataz):
+    """Fill the ends and interpolate the gaps of a line like the legacy algorithm."""
+    filled = imz.fill_list_ends(z_values, nodataz)
+    if filled is None:
+        return z_values
+    return legacy_interpolate_gaps(filled[0], legacy_distances(x, y), nodataz)
+
+
+### TIMING
+
+def time_stage(func, repeat):
+    """Run func repeat times and return the best wall and CPU times (seconds)."""
+    walls, cpus = [], []
+    for _ in range(repeat):
+        wall, cpu = time.perf_counter(), time.process_time()
+        func()
+        walls.append(time.perf_counter() - wall)
+        cpus.append(time.process_time() - cpu)
+    return {'wall': min(walls), 'cpu': min(cpus)}
+
+
+def benchmark_helpers(wkbs, repeat):
+    """Time the stages of the interpolation done by the pure helpers."""
+    parts = [coords for wkb in wkbs for _, _, coords in imz.read_line_wkb(wkb)[1]]
+    z_values = [coords[:, 2].copy() for coords in parts]
+    xy_values = [(coords[:, 0].copy(), coords[:, 1].copy()) for coords in parts]
+
+    stages = {}
+    stages['wkb_read'] = time_stage(lambda: [imz.read_line_wkb(wkb) for wkb in wkbs], repeat)
+    stages['multipart_split'] = time_stage(
+        lambda: [bytes(buffer[start:stop]) for wkb in wkbs
+                 for buffer, parts in [imz.read_line_wkb(wkb)] for start, stop, _ in parts],
+        repeat
+    )
+    stages['z_extraction'] = time_stage(
+        lambda: [imz.missing_z_mask(z, NODATAZ) for z in z_values], repeat
+    )
+    stages['distances'] = time_stage(
+        lambda: [imz.cumulative_distances(x, y) for x, y in xy_values], repeat
+    )
+    stages['interpolation'] = time_stage(
+        lambda: [imz.interpolate_line_z(x, y, z, NODATAZ) for (x, y), z in zip(xy_values, z_values)],
+        repeat
+    )
+    stages['interpolation_pchip'] = time_stage(
+        lambda: [imz.interpolate_line_z(x, y, z, NODATAZ, engine='pchip')
+                 for (x, y), z in zip(xy_values, z_values)],
+        repeat
+    )
+    stages['wkb_interpolation'] = time_stage(
+        lambda: [imz.interpolate_wkb_z(wkb, NODATAZ) for wkb in wkbs], repeat
+    )
+
+    # The legacy algorithm works on lists, one value at a time. Its gap loop
+    # is timed on the lines with filled ends and their distances, and the
+    # whole legacy interpolation is comparable to the 'interpolation' stage.
+    z_lists = [z.tolist() for z in z_values]
+    xy_lists = [(x.tolist(), y.tolist()) for x, y in xy_values]
+    stages['legacy_fill_list_ends'] = time_stage(
+        lambda: [imz.fill_list_ends(z, NODATAZ) for z in z_lists], repeat
+    )
+    filled_lists = [(imz.fill_list_ends(z, NODATAZ) or (z,))[0] for z in z_lists]
+    distance_lists = [legacy_distances(x, y) for x, y in xy_lists]
+    stages['legacy_interpolate_z'] = time_stage(
+        lambda: [legacy_interpolate_gaps(z, dist, NODATAZ) for z, dist in zip(filled_lists, distance_lists)],
+        repeat
+    )
+    stages['legacy_interpolation'] = time_stage(
+        lambda: [legacy_interpolate_line(x, y, z, NODATAZ) for (x, y), z in zip(xy_lists, z_lists)],
+        repeat
+    )
+    return stages
+
+
+def benchmark_qgis(wkbs, repeat):
+    """Time the stages involving QGIS and the whole algorithm, in a headless QgsApplication."""
+    from qgis.core import (QgsApplication, QgsFeature, QgsFeatureSink, QgsGeometry,
+                           QgsProcessingContext, QgsProcessingFeedback, QgsVectorLayer)
+
+    qgs = QgsApplication([], False)
+    qgs.initQgis()
+
+    # The multipart lines force a multipart layer.
+    layer = QgsVectorLayer('MultiLineStringZ?crs=EPSG:2154', 'lines', 'memory')
+    features = []
+    for wkb in wkbs:
+        feature = QgsFeature()
+        geometry = QgsGeometry()
+        geometry.fromWkb(wkb)
+        feature.setGeometry(geometry)
+        features.append(feature)
+    layer.dataProvider().addFeatures(features)
+
+    stages = {}
+    stages['qgis_read'] = time_stage(
+        lambda: [bytes(feature.geometry().asWkb()) for feature in layer.getFeatures()], repeat
+    )
+
+    def rebuild():
+        for wkb in wkbs:
+            geometry = QgsGeometry()
+            geometry.fromWkb(wkb)
+    stages['qgis_geometry_rebuild'] = time_stage(rebuild, repeat)
+
+    def write():
+        sink = QgsVectorLayer('MultiLineStringZ?crs=EPSG:2154', 'sink', 'memory')
+        sink.dataProvider().addFeatures(features, QgsFeatureSink.FastInsert)
+    stages['qgis_sink_write'] = time_stage(write, repeat)
+
+    # The stages timed by the algorithm itself, for each run.
+    runs = []
+
+    def run_algorithm():
+        alg = imz.InterpolateMissingZOnLine()
+        alg.initAlgorithm()
+        context = QgsProcessingContext()
+        feedback = QgsProcessingFeedback()
+        parameters = {
+            'INPUT': layer,
+            'NODATAZ': NODATAZ,
+            'MAX_LINE_MESSAGES': 0,
+            'OUTPUT': 'memory:',
+        }
+        ok, message = alg.checkParameterValues(parameters, context)
+        if not ok:
+            raise RuntimeError(message)
+        runs.append(alg.processAlgorithm(parameters, context, feedback)['TIMINGS'])
+    stages['algorithm'] = time_stage(run_algorithm, repeat)
+    best_run = min(runs, key=lambda timings: timings['wall'])
+    for name, timing in best_run['stages'].items():
+        stages['algorithm_' + name] = {'wall': timing['wall'], 'cpu': timing['cpu']}
+
+    qgs.exitQgis()
+    return stages
+
+
+### REPORTING
+
+def compare(results, baseline, threshold):
+    """Print the ratio of the wall times to the baseline ones and return the regressed stages."""
+    regressions = []
+    for name, timing in results['stages'].items():
+        reference = baseline['stages'].get(name)
+        if not reference or not reference['wall']:
+            continue
+        ratio = timing['wall'] / reference['wall']
+        flag = ''
+        if ratio > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print("{:<26} {:>10.4f} s  x{:.2f}{}".format(name, timing['wall'], ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lines', type=int, default=1000, help="Number of lines.")
+    parser.add_argument('--vertices', type=int, default=200, help="Number of vertices per line.")
+    parser.add_argument('--missing-ratio', type=float, default=0.3, help="Ratio of missing Z values.")
+    parser.add_argument('--gap-length', type=float, default=5., help="Mean length of the gaps (vertices).")
+    parser.add_argument('--end-gap-ratio', type=float, default=0.2, help="Ratio of lines with missing ends.")
+    parser.add_argument('--multipart-ratio', type=float, default=0.1, help="Ratio of multipart lines.")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the random generator.")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per stage, the best one is kept.")
+    parser.add_argument('--no-qgis', action='store_true', help="Skip the stages involving QGIS.")
+    parser.add_argument('--output', type=Path, help="JSON file to write the results to.")
+    parser.add_argument('--compare', type=Path, help="JSON file of a previous run to compare to.")
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help="Wall time ratio to the previous run above which a stage has regressed.")
+    args = parser.parse_args(argv)
+
+    parameters = {
+        'lines': args.lines,
+        'vertices': args.vertices,
+        'missing_ratio': args.missing_ratio,
+        'gap_length': args.gap_length,
+        'end_gap_ratio': args.end_gap_ratio,
+        'multipart_ratio': args.multipart_ratio,
+        'seed': args.seed,
+        'repeat': args.repeat,
+    }
+    wkbs = generate_dataset(
+        args.lines, args.vertices, args.missing_ratio, args.gap_length,
+        args.end_gap_ratio, args.multipart_ratio, args.seed
+    )
+    n_vertices = sum(len(coords) for wkb in wkbs for _, _, coords in imz.read_line_wkb(wkb)[1])
+
+    stages = benchmark_helpers(wkbs, args.repeat)
+    if not args.no_qgis:
+        stages.update(benchmark_qgis(wkbs, args.repeat))
+    for timing in stages.values():
+        timing['vertices_per_second'] = n_vertices / timing['wall'] if timing['wall'] else None
+
+    results = {
+        'parameters': parameters,
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+        },
+        'n_vertices': n_vertices,
+        'stages': stages,
+    }
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+
+    if args.compare:
+        baseline = json.loads(args.compare.read_text())
+        if baseline['parameters'] != parameters:
+            print("Warning: the parameters differ from the ones of the previous run.")
+        return 1 if compare(results, baseline, args.threshold) else 0
+    for name, timing in stages.items():
+        print("{:<26} {:>10.4f} s  {:>14,.0f} vertices/s".format(
+            name, timing['wall'], timing['vertices_per_second'] or 0))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -21,12 +21,20 @@ values of the layer. Doing it by hand could be really slow, particularly
 if the roads have curves and so many vertices.
 
 How edge cases are handled:
-- If a line feature only has missing values, it is left as is.
+- If a line feature only has missing values, it is left as is, unless
+  its ends can be filled from the neighbouring lines (optional).
 - If a line feature has no missing value, it is left as is.
+- Each part of a multipart line is processed separately, the output
+  keeping the multipart structure unless asked to explode it.
 
-The algorithm provides a message for each line that it processes,
-giving the user the ability to check that the quality of the
-input line Z layer and how it was processed.
+The module can also be run from the command line, without QGIS nor
+Processing being initialised, to process GeoPackage/Shapefile files
+with OGR (see main()).
+
+The algorithm reports a summary of how the lines were processed, giving
+the user the ability to check the quality of the input line Z layer.
+The first lines are also reported individually, and each line can be
+detailed in a CSV report.
 
 Notes:
     - This algorithm was developed based on the default
@@ -42,24 +50,64 @@ License: MIT
 """
 
 # Imports for the core algorithm
-import itertools
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import cProfile
+import csv
+import hashlib
+import heapq
+import json
 import math
+import os
+import pstats
+import re
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+
+import numpy as np
 
 # Imports for QGIS
-from PyQt5.QtCore import QCoreApplication
-from qgis.core import (QgsGeometry,
+from PyQt5.QtCore import QCoreApplication, QVariant
+from qgis.core import (Qgis,
+                       QgsCoordinateTransform,
+                       QgsCsException,
+                       QgsDistanceArea,
+                       QgsGeometry,
                        QgsFeature,
+                       QgsFeatureRequest,
                        QgsFeatureSink,
+                       QgsField,
+                       QgsFields,
                        QgsMapLayer,
+                       QgsPointXY,
                        QgsProcessing,
                        QgsProcessingException,
+                       QgsProcessingOutputNumber,
                        QgsProcessingAlgorithm,
+                       QgsProcessingParameterBand,
+                       QgsProcessingParameterBoolean,
+                       QgsProcessingParameterCrs,
+                       QgsProcessingParameterDefinition,
+                       QgsProcessingParameterDistance,
+                       QgsProcessingParameterEnum,
                        QgsProcessingParameterFeatureSource,
                        QgsProcessingParameterFeatureSink,
+                       QgsProcessingParameterFileDestination,
                        QgsProcessingParameterNumber,
+                       QgsProcessingParameterRasterLayer,
+                       QgsProcessingParameterString,
                        QgsProcessingUtils,
+                       QgsRectangle,
+                       QgsSpatialIndex,
+                       QgsVectorDataProvider,
+                       QgsVectorLayer,
                        QgsWkbTypes)
-from qgis import processing
 
 ### HELPER FUNCTIONS
 
@@ -92,431 +140,3221 @@ def interpolate_z(d_target, d_start, d_end, z_start, z_end):
     return z_start + (z_end - z_start) * (d_target - d_start) / (d_end - d_start)
 
 
-def idx_first_last_valid_items(list_, invalid_item):
-    """Determine the indexes of the first and last valid items in a sequence.
-    
+def cumulative_distances(x, y):
+    """Compute the distance of each vertex from the first one along a line.
+
     Parameters
     ----------
-    list_ : list
-        A list whose one or both ends has invalid items.
-    invalid_item : float
-        Invalid item that needs to be replaced (eg. 0).
-    
+    x : numpy.ndarray
+        X coordinates of the vertices.
+    y : numpy.ndarray
+        Y coordinates of the vertices.
+
     Returns
     -------
-    tuple
-        Two elements:
-            - int: first valid item
-            - int: last valid item
-    
+    numpy.ndarray
+        Cumulated segment lengths, the first one being 0.
+
     Usage
     -----
-    >>> idx_first_last_valid_items([0, 0, 1, 0, 2, 0], 0)
-    (2, 4)
-    >>> idx_first_last_valid_items([1, 1, 1], 0)
-    (0, 2)
+    >>> cumulative_distances(np.array([0, 3, 3]), np.array([0, 4, 5]))
+    array([0., 5., 6.])
     """
-    if list_[0] != invalid_item:
-        idx_first_valid_item = 0
-    else:
-        for idx, e in enumerate(list_):
-            if e == invalid_item:
-                continue
-            idx_first_valid_item = idx
-            break
-    if list_[-1] != invalid_item:
-        idx_last_valid_item = len(list_) - 1
+    seg_lengths = np.hypot(np.diff(x), np.diff(y))
+    return np.concatenate(([0.], np.cumsum(seg_lengths)))
+
+
+def missing_z_mask(z, nodataz, nodataz_tolerance=0.):
+    """Flag the missing values of an array of Z values.
+
+    Parameters
+    ----------
+    z : numpy.ndarray
+        Z values of the vertices.
+    nodataz : float or sequence of floats
+        Value(s) used to declare a missing Z value (eg. 0). NaN
+        can be one of them, NaN Z values are then missing.
+    nodataz_tolerance : float, optional
+        Absolute tolerance when comparing the Z values to the NoData values.
+
+    Returns
+    -------
+    numpy.ndarray
+        Boolean array, True where the Z value is missing.
+
+    Usage
+    -----
+    >>> missing_z_mask(np.array([0., 1., 0.]), 0)
+    array([ True, False,  True])
+    >>> missing_z_mask(np.array([0., -9999.0000001, np.nan, 2.]), [0, -9999, np.nan], 1e-6)
+    array([ True,  True,  True, False])
+    """
+    z = np.asarray(z)
+    values = np.atleast_1d(np.asarray(nodataz, dtype=float))
+    is_nan = np.isnan(values)
+    values = values[~is_nan]
+    if len(values) == 1 and not nodataz_tolerance:
+        missing = z == values[0]
+    elif nodataz_tolerance:
+        missing = (np.abs(z[..., np.newaxis] - values) <= nodataz_tolerance).any(axis=-1)
     else:
-        for idx, e in enumerate(reversed(list_)):
-            if e == invalid_item:
-                continue
-            idx_last_valid_item = len(list_) - idx - 1
-            break
-    return idx_first_valid_item, idx_last_valid_item
+        missing = np.isin(z, values)
+    if is_nan.any():
+        missing |= np.isnan(z)
+    return missing
 
 
-def fill_list_ends(list_, invalid_item):
-    """Fill the ends of a list with the first/last valid item found.
-    
+def parse_nodataz_values(text):
+    """Parse a list of NoData Z values separated by commas or semicolons.
+
+    Usage
+    -----
+    >>> parse_nodataz_values('-9999; nan, 1e9')
+    [-9999.0, nan, 1000000000.0]
+    >>> parse_nodataz_values('')
+    []
+    """
+    return [float(value) for value in re.split(r'[,;]', text) if value.strip()]
+
+
+def fill_array_ends(values, missing):
+    """Fill the ends of an array with the first/last valid value found.
+
     Parameters
     ----------
-    list_ : list
-        A list whose one or both ends has invalid items.
-    invalid_item : float
-        Invalid item that needs to be replaced (eg. 0).
-    
+    values : numpy.ndarray
+        Array whose one or both ends has missing values.
+    missing : numpy.ndarray
+        Boolean array, True where the value is missing. It must
+        have at least one False item.
+
     Returns
     -------
     tuple
         Two elements:
-            - list: Original list with filled ends
+            - numpy.ndarray: Copy of the original array with filled ends
             - int: Number of filled items.
-    
+
     Usage
     -----
-    >>> fill_list_ends([0, 0, 1, 0, 2, 0], 0)
-    ([1, 1, 1, 0, 2, 2], 3)
-    >>> fill_list_ends([0, 0, 0], 0)
-    None
-    >>> fill_list_ends([1, 1, 1], 0)
-    ([1, 1, 1], 0)
+    >>> fill_array_ends(np.array([0, 0, 1, 0, 2, 0]), np.array([1, 1, 0, 1, 0, 1], dtype=bool))
+    (array([1, 1, 1, 0, 2, 2]), 3)
     """
-    # All the items are invalid, we don't know how to fill the new list.
-    if all(e == invalid_item for e in list_):
-        return None
-    # These is no invalid item, return the original list.
-    if invalid_item not in list_:
-        return list_, 0
-    idx_first_valid_item, idx_last_valid_item = idx_first_last_valid_items(list_, invalid_item)
-    new_list = list_.copy()
-    for i in range(len(list_)):
-        # Fill the new list ends with the valid items.
-        if i < idx_first_valid_item:
-            new_list[i] = list_[idx_first_valid_item]
-        if i > idx_last_valid_item:
-            new_list[i] = list_[idx_last_valid_item]
-    no_filled_item = len(list_) - idx_last_valid_item - 1 + idx_first_valid_item
-    return new_list, no_filled_item
-
-### QGIS ALGORITHM
-
-class InterpolateMissingZOnLine(QgsProcessingAlgorithm):
+    valid_idx = np.flatnonzero(~missing)
+    first, last = valid_idx[0], valid_idx[-1]
+    new_values = values.copy()
+    new_values[:first] = values[first]
+    new_values[last + 1:] = values[last]
+    return new_values, int(first + len(values) - 1 - last)
 
-    # Constants used to refer to parameters and outputs. They will be
-    # used when calling the algorithm from another algorithm, or when
-    # calling from the QGIS console.
 
-    INPUT = 'INPUT'
-    OUTPUT = 'OUTPUT'
-    NODATAZ = 'NODATAZ'
+# Engines available to interpolate the gaps, see interpolate_line_z().
+ENGINES = ('linear', 'pchip', 'dem')
 
-    def tr(self, string):
-        """
-        Returns a translatable string with the self.tr() function.
-        """
-        return QCoreApplication.translate('Processing', string)
 
-    def createInstance(self):
-        return InterpolateMissingZOnLine()
+def pchip_interpolate(x, xp, fp):
+    """Monotone piecewise cubic (PCHIP) interpolation.
 
-    def name(self):
-        """
-        Returns the algorithm name, used for identifying the algorithm. This
-        string should be fixed for the algorithm, and must not be localised.
-        The name should be unique within each provider. Names should contain
-        lowercase alphanumeric characters only and no spaces or other
-        formatting characters.
-        """
-        return 'interpolate_missing_z_on_line'
+    The slopes at the known points are set with the Fritsch-Carlson method,
+    so that the curve doesn't overshoot the known values (no artificial bump
+    or dip between two anchors), unlike a natural cubic spline.
 
-    def displayName(self):
-        """
-        Returns the translated algorithm name, which should be used for any
-        user-visible display of the algorithm name.
-        """
-        return self.tr('Interpolate missing Z on line')
+    Parameters
+    ----------
+    x : numpy.ndarray
+        Points to evaluate, within the range of xp.
+    xp : numpy.ndarray
+        Known points, strictly increasing.
+    fp : numpy.ndarray
+        Known values.
 
-    def group(self):
-        """
-        Returns the name of the group this algorithm belongs to. This string
-        should be localised.
-        """
-        return self.tr('External Scripts')
+    Returns
+    -------
+    numpy.ndarray
+        Interpolated values, linearly interpolated with less than 3 known
+        points or with duplicated known points.
 
-    def groupId(self):
-        """
-        Returns the unique ID of the group this algorithm belongs to. This
-        string should be fixed for the algorithm, and must not be localised.
-        The group id should be unique within each provider. Group id should
-        contain lowercase alphanumeric characters only and no spaces or other
-        formatting characters.
-        """
-        return 'externalscripts'
+    Usage
+    -----
+    >>> pchip_interpolate(np.array([0.5, 1.5]), np.array([0., 1., 2.]), np.array([0., 1., 1.]))
+    array([0.6875, 1.    ])
+    """
+    xp = np.asarray(xp, dtype=float)
+    fp = np.asarray(fp, dtype=float)
+    h = np.diff(xp)
+    if len(xp) < 3 or not (h > 0).all():
+        return np.interp(x, xp, fp)
+    delta = np.diff(fp) / h
 
-    def shortHelpString(self):
-        """
-        Returns a localised short helper string for the algorithm. This string
-        should provide a basic description about what the algorithm does and the
-        parameters and outputs associated with it..
-        """
-        return self.tr(
-            "This algorithm interpolates missing Z values on a lineZ layer.\n\n"
-            "QGIS doesn't have a NULL for declaring missing Z values in vector layers. "
-            "A newly created vector layer will have Z values defaulting to 0. "
-            "The parameter 'NoData Z' provides a way to declare what numerical value should "
-            "be considered as the NoData one (0 in most cases).\n\n"
-            "If the first or last vertices of a line have missing values, the "
-            "algorithm will fill them in (extrapolate) by setting their value "
-            "to the first/last valid ones found.\n\n"
-            "Author: Maxime Liquet"
+    # Weighted harmonic mean of the neighbouring secants, 0 at the extrema.
+    slopes = np.zeros_like(fp)
+    w1 = 2 * h[1:] + h[:-1]
+    w2 = h[1:] + 2 * h[:-1]
+    same_sign = delta[:-1] * delta[1:] > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slopes[1:-1] = np.where(
+            same_sign, (w1 + w2) / (w1 / delta[:-1] + w2 / delta[1:]), 0.
         )
-    
-    def helpUrl(self):
-        return "https://github.com/maximlt/qgis_interpolate_missing_z_line"
+    # Non-centered three-point estimates at the ends, kept shape-preserving.
+    for end, h0, h1, d0, d1 in ((0, h[0], h[1], delta[0], delta[1]),
+                                (-1, h[-1], h[-2], delta[-1], delta[-2])):
+        slope = ((2 * h0 + h1) * d0 - h0 * d1) / (h0 + h1)
+        if np.sign(slope) != np.sign(d0):
+            slope = 0.
+        elif np.sign(d0) != np.sign(d1) and abs(slope) > abs(3 * d0):
+            slope = 3 * d0
+        slopes[end] = slope
 
-    def initAlgorithm(self, config=None):
-        """
-        Here we define the inputs and output of the algorithm, along
-        with some other properties.
-        """
-        # We add the input vector features source.
-        # The algorithm only works with lines.
-        self.addParameter(
-            QgsProcessingParameterFeatureSource(
-                self.INPUT,
-                self.tr('Input Line Z layer'),
-                [QgsProcessing.TypeVectorLine]
-            )
-        )
+    x = np.asarray(x, dtype=float)
+    idx = np.clip(np.searchsorted(xp, x, side='right') - 1, 0, len(xp) - 2)
+    t = (x - xp[idx]) / h[idx]
+    t2 = t * t
+    t3 = t2 * t
+    return (
+        (2 * t3 - 3 * t2 + 1) * fp[idx]
+        + (t3 - 2 * t2 + t) * h[idx] * slopes[idx]
+        + (-2 * t3 + 3 * t2) * fp[idx + 1]
+        + (t3 - t2) * h[idx] * slopes[idx + 1]
+    )
 
-        # From https://gis.stackexchange.com/questions/285570/changing-parameter-values-according-to-other-parameter-choice-in-processing-scri
-        self.addParameter(
-            QgsProcessingParameterNumber(
-                name=self.NODATAZ,
-                description=self.tr('NoData Z'),
-                type=QgsProcessingParameterNumber.Double,
-                defaultValue=0,
-                optional=False,
-            )
-        )
-        
-        # We add a feature sink in which to store our processed features (this
-        # usually takes the form of a newly created vector layer when the
-        # algorithm is run in QGIS).
-        self.addParameter(
-            QgsProcessingParameterFeatureSink(
-                self.OUTPUT,
-                self.tr('InterpolatedMissingZ')
-            )
-        )
 
-    def processAlgorithm(self, parameters, context, feedback):
-        """Here is where the processing itself takes place.
-        
-        Validate the input (could have used prepareAlgorithm() apparently),
-        perform the computation and generate the output.
-        """
+def interpolate_gaps(dist, values, missing, engine='linear'):
+    """Interpolate the missing values found between two valid ones.
 
-        # Retrieve the feature source and sink. The 'dest_id' variable is used
-        # to uniquely identify the feature sink, and must be included in the
-        # dictionary returned by the processAlgorithm function.
-        source = self.parameterAsSource(
-            parameters,
-            self.INPUT,
-            context
-        )
+    Parameters
+    ----------
+    dist : numpy.ndarray
+        Distance of each vertex from the first one.
+    values : numpy.ndarray
+        Values to interpolate, both ends must be valid.
+    missing : numpy.ndarray
+        Boolean array, True where the value is missing.
+    engine : str, optional
+        'linear' (default) or 'pchip' (monotone cubic, see pchip_interpolate()),
+        the interpolation being based on the distance.
 
-        # From https://docs.qgis.org/testing/en/docs/user_manual/processing/scripts.html#the-alg-decorator
-        nodataz = self.parameterAsDouble(
-            parameters,
-            'NODATAZ',
-            context
-        )
+    Returns
+    -------
+    numpy.ndarray
+        Copy of the original values with the gaps interpolated.
 
-        # If source was not found, throw an exception to indicate that the algorithm
-        # encountered a fatal error. The exception text can be any string, but in this
-        # case we use the pre-built invalidSourceError method to return a standard
-        # helper text for when a source cannot be evaluated
-        if source is None:
-            raise QgsProcessingException(self.invalidSourceError(parameters, self.INPUT))
+    Usage
+    -----
+    >>> interpolate_gaps(np.array([0., 1., 3.]), np.array([0., -1., 3.]), np.array([False, True, False]))
+    array([0., 1., 3.])
+    """
+    new_values = values.astype(float)
+    interpolate = pchip_interpolate if engine == 'pchip' else np.interp
+    new_values[missing] = interpolate(dist[missing], dist[~missing], values[~missing])
+    return new_values
 
-        # Adapted from https://github.com/qgis/QGIS/blob/master/python/plugins/processing/algs/qgis/GeometryConvert.py
-        if not QgsWkbTypes.hasZ(source.wkbType()):
-            raise QgsProcessingException(self.tr("The input layer has no Z dimension."))
 
-        (sink, dest_id) = self.parameterAsSink(
-            parameters,
-            self.OUTPUT,
-            context,
-            source.fields(),
-            source.wkbType(),
-            source.sourceCrs()
-        )
+def sample_grid(grid, x_min, y_max, cell_width, cell_height, x, y):
+    """Bilinearly sample a north-up grid (eg. a raster block) at some points.
 
-        # If sink was not created, throw an exception to indicate that the algorithm
-        # encountered a fatal error. The exception text can be any string, but in this
-        # case we use the pre-built invalidSinkError method to return a standard
-        # helper text for when a sink cannot be evaluated
-        if sink is None:
-            raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT))
+    Parameters
+    ----------
+    grid : numpy.ndarray
+        (rows, columns) values, NaN where unknown.
+    x_min, y_max : float
+        Coordinates of the top left corner of the grid.
+    cell_width, cell_height : float
+        Size of a cell.
+    x, y : numpy.ndarray
+        Coordinates of the points.
 
-        # In QGIS 3 shapelines containing lines are MultiLineStrings. It needs a
-        # nested loops to loop over each line they contain.
-        # I haven't found a method to convert them to single parts in Python,
-        # so I use this processing algorithm to 
-        multipart_to_singlepart_algo = processing.run(
-            "native:multiparttosingleparts",
-            {
-                'INPUT': parameters[self.INPUT],
-                'OUTPUT': 'memory:'
-            },
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True
-        )
-        # There has to be a better way but it seemed like the output was always a string here.
-        source = QgsProcessingUtils.mapLayerFromString(multipart_to_singlepart_algo['OUTPUT'], context=context)
+    Returns
+    -------
+    numpy.ndarray
+        Value at each point, NaN outside of the grid or next to an unknown cell.
 
-        # Compute the number of steps to display within the progress bar and
-        # get features from source
-        total = 100.0 / source.featureCount() if source.featureCount() else 0
-        features = source.getFeatures()
+    Usage
+    -----
+    >>> grid = np.array([[0., 1.], [2., 3.]])
+    >>> sample_grid(grid, 0, 2, 1, 1, np.array([1., 0.5, 3.]), np.array([1., 1.5, 1.]))
+    array([1.5, 0. , nan])
+    """
+    n_rows, n_cols = grid.shape
+    # Position in cells from the center of the top left cell.
+    col = (np.asarray(x, dtype=float) - x_min) / cell_width - 0.5
+    row = (y_max - np.asarray(y, dtype=float)) / cell_height - 0.5
+    col0 = np.clip(np.floor(col), 0, max(n_cols - 2, 0)).astype(int)
+    row0 = np.clip(np.floor(row), 0, max(n_rows - 2, 0)).astype(int)
+    col1 = np.minimum(col0 + 1, n_cols - 1)
+    row1 = np.minimum(row0 + 1, n_rows - 1)
+    tc = np.clip(col - col0, 0, 1)
+    tr = np.clip(row - row0, 0, 1)
+    values = (
+        (1 - tr) * ((1 - tc) * grid[row0, col0] + tc * grid[row0, col1])
+        + tr * ((1 - tc) * grid[row1, col0] + tc * grid[row1, col1])
+    )
+    outside = (col < -0.5) | (col > n_cols - 0.5) | (row < -0.5) | (row > n_rows - 0.5)
+    values[outside] = np.nan
+    return values
 
-        feedback.pushInfo(
-            self.tr("Processing {featurecount} line(s)...").format(featurecount=source.featureCount())
-        )
-        # Looping through all the lines found in the layer.
-        for current, feature in enumerate(features):
-            # Stop the algorithm if cancel button is clicked
-            if feedback.isCanceled():
-                break
 
-            # Using .constGet() allows to retrieve the Z values.
-            line = feature.geometry().constGet()
-            original_z_values = [pt.z() for pt in line]
+def interpolate_line_z(x, y, z, nodataz, anchors=None, nodataz_tolerance=0., engine='linear',
+                       trend=None, dist=None, max_gap=None, fill_long_gaps=False):
+    """Fill in the missing Z values of a line.
 
-            # Do not do anything special with a line if it does not contain any NoData Z.
-            # So it's just copied to the output (=sink).
-            # Yet, report is as a warning to the user.
-            if nodataz not in original_z_values:
-                sink.addFeature(feature, QgsFeatureSink.FastInsert)
-                feedback.reportError(
-                    self.tr(
-                        "Line {feature_id}: Left unchanched as it has no vertex with missing value."
-                    ).format(feature_id=feature.id())
-                )
-                continue
+    The missing values at the ends of the line are set to the first/last
+    valid value found, the other ones are interpolated based on the distance
+    along the line. If anchors are given, they're used as the values of the
+    first/last vertices when these are missing.
 
-            # A line that would contain only NoData Z is considered as okayish
-            # and doesn't stop the algorithm. It's also copied to the output.
-            # It is notified to the user though through an error message that
-            # doesn't stop the algorithm.
-            if all(z == nodataz for z in original_z_values):
-                sink.addFeature(feature, QgsFeatureSink.FastInsert)
-                feedback.reportError(
-                    self.tr(
-                        "Line {feature_id}: Contains missing values only, left as is."
-                    ).format(feature_id=feature.id())
-                )
-                continue
+    With the 'dem' engine, the missing values follow the trend (eg. the Z
+    values sampled on a DEM) shifted to match the valid values: the offsets
+    between the valid values and the trend are linearly interpolated (or
+    copied at the ends) and added back to the trend. The vertices where
+    the trend is unknown fall back to the 'linear' engine.
 
-            # Computing the interpolated values will be based on this list.
-            base_z_values = original_z_values
+    The gaps (missing values between two valid ones) longer than max_gap
+    are left missing, or interpolated if fill_long_gaps is True, and
+    counted in both cases.
 
-            # The start and the end vertices of a line can have missing values.
-            # Their values are filled with the closest (in terms of indexes, not geographically)
-            # non missing value.
-            if base_z_values[0] == nodataz or base_z_values[-1] == nodataz:
-                base_z_values, no_filled_vertices = fill_list_ends(original_z_values, invalid_item=nodataz)
-                feedback.reportError(
-                    self.tr(
-                        "Line {feature_id}: Has one or both end(s) with missing Z values. "
-                        "{no_filled_vertices} vertices set with the first/last valid Z value(s) found."
-                    ).format(feature_id=feature.id(), no_filled_vertices=no_filled_vertices)
-                )
-                # Dev check
-                if len(base_z_values) != len(original_z_values):
-                    raise QgsProcessingException(
-                        self.tr(
-                            "Problem with the code itself: "
-                            "The count of filled vertices is different than the original count."
-                        )
-                )
+    Parameters
+    ----------
+    x : numpy.ndarray
+        X coordinates of the vertices.
+    y : numpy.ndarray
+        Y coordinates of the vertices.
+    z : numpy.ndarray
+        Z values of the vertices.
+    nodataz : float or sequence of floats
+        Value(s) used to declare a missing Z value (eg. 0), see missing_z_mask().
+    nodataz_tolerance : float, optional
+        Absolute tolerance when comparing the Z values to the NoData values.
+    anchors : tuple, optional
+        Z values (float or NaN if unknown) of the first and last vertices,
+        eg. found on the neighbouring lines.
+    engine : str, optional
+        One of ENGINES: 'linear' (default), 'pchip' (monotone cubic) or 'dem'.
+    trend : numpy.ndarray, optional
+        Z value of the trend at each vertex (NaN if unknown), required by the 'dem' engine.
+    dist : numpy.ndarray, optional
+        Distance of each vertex from the first one (eg. measured in another CRS),
+        computed from x and y with cumulative_distances() if not given.
+    max_gap : tuple, optional
+        Maximum distance (in the units of dist) between the valid vertices
+        around a gap and maximum number of missing vertices of a gap (0 for
+        no limit).
+    fill_long_gaps : bool, optional
+        Whether to interpolate the gaps longer than max_gap anyway.
 
-            # Calculate each segment (line between two vertices) length.
-            points = feature.geometry().asPolyline()
-            seg_lengths = [
-                math.sqrt(pt_i.sqrDist(pt_j)) 
-                for pt_i, pt_j in zip(points[:-1], points[1:])
+    Returns
+    -------
+    tuple
+        Two elements:
+            - numpy.ndarray: New Z values (the input array isn't modified)
+            - dict: Statistics of the line, with the keys 'status' ('complete',
+              'missing_only', 'long_gap' if its gaps are all longer than max_gap
+              and left missing, the line being unchanged, or 'interpolated'),
+              'n_vertices', 'n_missing',
+              'n_anchored' (ends set with the anchors), 'n_end_filled',
+              'n_interpolated', 'max_gap_length' (the distance between
+              the valid vertices around the longest gap, 0 if none), 'n_long_gaps'
+              (gaps longer than max_gap), 'n_left_missing' (vertices of the long
+              gaps left missing) and 'gaps' (list of [index of the valid vertex
+              before, index of the valid vertex after, length] of each gap).
+
+    Usage
+    -----
+    >>> new_z, stats = interpolate_line_z([0, 1, 2, 3, 4], [0, 0, 0, 0, 0], [0, 1, 0, 3, 0], 0)
+    >>> new_z
+    array([1., 1., 2., 3., 3.])
+    >>> stats['n_end_filled'], stats['n_interpolated'], stats['max_gap_length']
+    (2, 1, 2.0)
+    >>> interpolate_line_z([0, 1, 2], [0, 0, 0], [0, 0, 0], 0, anchors=(2, np.nan))[0]
+    array([2., 2., 2.])
+    >>> trend = np.array([10., 12., 11., 14., 15.])
+    >>> interpolate_line_z([0, 1, 2, 3, 4], [0, 0, 0, 0, 0], [0, 2, 0, 4, 0], 0, engine='dem', trend=trend)[0]
+    array([0., 2., 1., 4., 5.])
+    >>> new_z, stats = interpolate_line_z([0, 1, 2, 3, 4, 5], [0] * 6, [1, 0, 3, 0, 0, 6], 0, max_gap=(0, 1))
+    >>> new_z, stats['n_long_gaps'], stats['n_left_missing'], stats['gaps']
+    (array([1., 2., 3., 0., 0., 6.]), 1, 2, [[0, 2, 2.0], [2, 5, 3.0]])
+    >>> interpolate_line_z([0, 1, 2, 3, 4], [0] * 5, [1, 0, 0, 0, 5], 0, max_gap=(0, 1))[1]['status']
+    'long_gap'
+    """
+    z = np.asarray(z, dtype=float)
+    missing = missing_z_mask(z, nodataz, nodataz_tolerance)
+    n_missing = int(np.count_nonzero(missing))
+    n_anchored = 0
+    if anchors is not None and n_missing:
+        z = z.copy()
+        missing = missing.copy()
+        for idx, anchor in zip((0, -1), anchors):
+            if missing[idx] and not np.isnan(anchor):
+                z[idx] = anchor
+                missing[idx] = False
+                n_anchored += 1
+    stats = {
+        'status': 'interpolated',
+        'n_vertices': len(z),
+        'n_missing': n_missing,
+        'n_anchored': n_anchored,
+        'n_end_filled': 0,
+        'n_interpolated': 0,
+        'max_gap_length': 0.,
+        'n_long_gaps': 0,
+        'n_left_missing': 0,
+        'gaps': [],
+    }
+    if n_missing == 0:
+        stats['status'] = 'complete'
+        return z.copy(), stats
+    if missing.all():
+        stats['status'] = 'missing_only'
+        return z.copy(), stats
+
+    # The ends are filled by index, not by distance, so that they can be
+    # used as the anchors of the interpolation.
+    new_z, n_end_filled = fill_array_ends(z, missing)
+    valid_idx = np.flatnonzero(~missing)
+    inner = slice(valid_idx[0], valid_idx[-1] + 1)
+    inner_missing = missing[inner]
+    if inner_missing.any():
+        if dist is None:
+            dist = cumulative_distances(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+        new_z[inner] = interpolate_gaps(dist[inner], new_z[inner], inner_missing, engine)
+        gap_ends = np.flatnonzero(np.diff(valid_idx) > 1)
+        gap_starts, gap_stops = valid_idx[gap_ends], valid_idx[gap_ends + 1]
+        gap_lengths = dist[gap_stops] - dist[gap_starts]
+        stats['max_gap_length'] = float(np.max(gap_lengths))
+        stats['gaps'] = [
+            list(gap) for gap in zip(gap_starts.tolist(), gap_stops.tolist(), gap_lengths.tolist())
+        ]
+    if engine == 'dem' and trend is not None:
+        trend = np.asarray(trend, dtype=float)
+        known = ~missing & ~np.isnan(trend)
+        follow = missing & ~np.isnan(trend)
+        if known.any() and follow.any():
+            if dist is None:
+                dist = cumulative_distances(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+            offsets = np.interp(dist[follow], dist[known], z[known] - trend[known])
+            new_z[follow] = trend[follow] + offsets
+    if max_gap is not None and stats['gaps']:
+        max_distance, max_vertices = max_gap
+        long_gaps = (
+            (max_distance > 0) & (gap_lengths > max_distance)
+            | (max_vertices > 0) & (gap_stops - gap_starts - 1 > max_vertices)
+        )
+        stats['n_long_gaps'] = int(np.count_nonzero(long_gaps))
+        if not fill_long_gaps:
+            for start, stop in zip(gap_starts[long_gaps], gap_stops[long_gaps]):
+                new_z[start + 1:stop] = z[start + 1:stop]
+                stats['n_left_missing'] += int(stop - start - 1)
+    stats['n_end_filled'] = n_end_filled
+    stats['n_interpolated'] = n_missing - n_anchored - n_end_filled - stats['n_left_missing']
+    if not n_anchored and not n_end_filled and not stats['n_interpolated']:
+        # All the gaps were left missing, the line is unchanged.
+        stats['status'] = 'long_gap'
+    return new_z, stats
+
+
+# Geometry type codes of the WKB format (OGC Simple Features).
+WKB_LINESTRING = 2
+WKB_MULTILINESTRING = 5
+
+
+def wkb_type_info(wkb_type):
+    """Decode a WKB geometry type code.
+
+    Both the ISO codes (eg. 1002 for LineStringZ) and the ones flagged
+    with the high bits (eg. 0x80000002 for LineString25D) are handled.
+
+    Parameters
+    ----------
+    wkb_type : int
+        WKB geometry type code.
+
+    Returns
+    -------
+    tuple
+        Three elements:
+            - int: Base geometry type (eg. 2 for a LineString)
+            - bool: Whether the geometry has a Z dimension
+            - bool: Whether the geometry has a M dimension
+
+    Usage
+    -----
+    >>> wkb_type_info(3005)
+    (5, True, True)
+    >>> wkb_type_info(0x80000002)
+    (2, True, False)
+    """
+    has_z = bool(wkb_type & 0x80000000)
+    has_m = bool(wkb_type & 0x40000000)
+    iso_dims, base_type = divmod(wkb_type & 0x0FFFFFFF, 1000)
+    has_z = has_z or iso_dims in (1, 3)
+    has_m = has_m or iso_dims in (2, 3)
+    return base_type, has_z, has_m
+
+
+def _read_wkb_header(buffer, offset):
+    """Return the byte order ('<' or '>') and the type code of the WKB geometry found at offset."""
+    byte_order = '<' if buffer[offset] == 1 else '>'
+    (wkb_type,) = struct.unpack_from(byte_order + 'I', buffer, offset + 1)
+    return byte_order, wkb_type
+
+
+def read_line_wkb(wkb):
+    """Map the vertices of a line WKB onto NumPy arrays.
+
+    The WKB is copied once into a writable buffer, the arrays returned
+    are views of this buffer (no copy), modifying them modifies the buffer.
+
+    Parameters
+    ----------
+    wkb : bytes
+        WKB of a LineString or MultiLineString with a Z dimension (and optionally M).
+
+    Returns
+    -------
+    tuple
+        Two elements:
+            - bytearray: Writable copy of the WKB
+            - list: One tuple (start, stop, coords) per line part, start and stop
+              being the byte offsets of the part WKB in the buffer and coords
+              a (no. of vertices, no. of dimensions) float64 array whose
+              columns are X, Y, Z (and M).
+
+    Usage
+    -----
+    >>> wkb = struct.pack('<BII3d3d', 1, 1002, 2, 0, 0, 1, 1, 1, 0)
+    >>> buffer, parts = read_line_wkb(wkb)
+    >>> parts[0][2][:, 2]
+    array([1., 0.])
+    """
+    buffer = bytearray(wkb)
+    byte_order, wkb_type = _read_wkb_header(buffer, 0)
+    base_type, has_z, _ = wkb_type_info(wkb_type)
+    if not has_z:
+        raise ValueError("The geometry has no Z dimension.")
+    if base_type == WKB_LINESTRING:
+        part_offsets = [0]
+    elif base_type == WKB_MULTILINESTRING:
+        (n_parts,) = struct.unpack_from(byte_order + 'I', buffer, 5)
+        part_offsets = [9]
+    else:
+        raise ValueError("Unsupported WKB geometry type: {}.".format(wkb_type))
+
+    parts = []
+    offset = part_offsets[0]
+    for _ in range(1 if base_type == WKB_LINESTRING else n_parts):
+        byte_order, wkb_type = _read_wkb_header(buffer, offset)
+        _, has_z, has_m = wkb_type_info(wkb_type)
+        n_dims = 2 + has_z + has_m
+        (n_vertices,) = struct.unpack_from(byte_order + 'I', buffer, offset + 5)
+        coords = np.frombuffer(
+            buffer, dtype=byte_order + 'f8', count=n_vertices * n_dims, offset=offset + 9
+        ).reshape(n_vertices, n_dims)
+        stop = offset + 9 + coords.nbytes
+        parts.append((offset, stop, coords))
+        offset = stop
+    return buffer, parts
+
+
+def interpolate_wkb_z(wkb, nodataz, part_anchors=None, nodataz_tolerance=0., engine='linear',
+                      part_trends=None, part_distances=None, max_gap=None, fill_long_gaps=False):
+    """Fill in the missing Z values of each part of a line WKB.
+
+    Parameters
+    ----------
+    wkb : bytes
+        WKB of a LineString or MultiLineString with a Z dimension.
+    nodataz : float or sequence of floats
+        Value(s) used to declare a missing Z value (eg. 0), see missing_z_mask().
+    nodataz_tolerance : float, optional
+        Absolute tolerance when comparing the Z values to the NoData values.
+    part_anchors : list, optional
+        Anchors of each part, see interpolate_line_z().
+    engine : str, optional
+        Interpolation engine, see interpolate_line_z().
+    part_trends : list, optional
+        Trend of each part (eg. sampled on a DEM), see interpolate_line_z().
+    part_distances : list, optional
+        Cumulative distances of each part, see interpolate_line_z().
+    max_gap : tuple, optional
+        Limits of the gaps, see interpolate_line_z().
+    fill_long_gaps : bool, optional
+        Whether to interpolate the gaps longer than max_gap anyway.
+
+    Returns
+    -------
+    tuple
+        Three elements:
+            - bytearray: WKB whose Z values were patched in place, the XY and M
+              values are left untouched
+            - list: Parts as returned by read_line_wkb()
+            - list: Statistics of each part as returned by interpolate_line_z().
+
+    Usage
+    -----
+    >>> wkb = struct.pack('<BII3d3d', 1, 1002, 2, 0, 0, 1, 1, 1, 0)
+    >>> buffer, parts, part_stats = interpolate_wkb_z(wkb, 0)
+    >>> struct.unpack_from('<6d', buffer, 9)
+    (0.0, 0.0, 1.0, 1.0, 1.0, 1.0)
+    """
+    buffer, parts = read_line_wkb(wkb)
+    part_stats = []
+    for part_idx, (_, _, coords) in enumerate(parts):
+        anchors = None if part_anchors is None else part_anchors[part_idx]
+        trend = None if part_trends is None else part_trends[part_idx]
+        dist = None if part_distances is None else part_distances[part_idx]
+        new_z, stats = interpolate_line_z(
+            coords[:, 0], coords[:, 1], coords[:, 2], nodataz, anchors, nodataz_tolerance,
+            engine, trend, dist, max_gap, fill_long_gaps
+        )
+        if stats['status'] == 'interpolated':
+            coords[:, 2] = new_z
+        part_stats.append(stats)
+    return buffer, parts, part_stats
+
+
+def interpolate_wkbs_z(payload, nodataz, nodataz_tolerance=0., engine='linear', max_gap=None,
+                       fill_long_gaps=False):
+    """Fill in the missing Z values of a batch of line WKBs.
+
+    This is the unit of work sent to the worker processes of the command
+    line, it doesn't depend on QGIS objects.
+
+    Parameters
+    ----------
+    payload : list
+        Tuples (feature id, WKB, anchors of each part or None, trend of each
+        part or None, distances of each part or None), the WKB being None
+        for a feature without geometry.
+    nodataz : float or sequence of floats
+        Value(s) used to declare a missing Z value (eg. 0), see missing_z_mask().
+    nodataz_tolerance : float, optional
+        Absolute tolerance when comparing the Z values to the NoData values.
+    engine : str, optional
+        Interpolation engine, see interpolate_line_z().
+    max_gap : tuple, optional
+        Limits of the gaps, see interpolate_line_z().
+    fill_long_gaps : bool, optional
+        Whether to interpolate the gaps longer than max_gap anyway.
+
+    Returns
+    -------
+    list
+        One item per WKB, in the input order: None for a feature without geometry,
+        the output of interpolate_wkb_z() otherwise.
+
+    Usage
+    -----
+    >>> wkb = struct.pack('<BII3d3d', 1, 1002, 2, 0, 0, 1, 1, 1, 0)
+    >>> payload = [(1, wkb, None, None, None), (2, None, None, None, None)]
+    >>> [result is None for result in interpolate_wkbs_z(payload, 0)]
+    [False, True]
+    """
+    return [
+        None if wkb is None else interpolate_wkb_z(
+            wkb, nodataz, part_anchors, nodataz_tolerance, engine, part_trends, part_distances,
+            max_gap, fill_long_gaps
+        )
+        for _, wkb, part_anchors, part_trends, part_distances in payload
+    ]
+
+
+def interpolate_payload(payload, nodataz, nodataz_tolerance=0., engine='linear', executor=None,
+                        max_workers=1, max_gap=None, fill_long_gaps=False):
+    """Run interpolate_wkbs_z() on a batch, shared between the workers of an executor if given.
+
+    Each worker processes a contiguous slice of the batch, the results
+    being returned in the input order. The executor can run threads or
+    processes, the slices and their results being picklable.
+
+    Usage
+    -----
+    >>> wkb = struct.pack('<BII3d3d', 1, 1002, 2, 0, 0, 1, 1, 1, 0)
+    >>> with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+    ...     results = interpolate_payload([(i, wkb, None, None, None) for i in range(3)], 0,
+    ...                                   executor=executor, max_workers=2)
+    >>> [result[2][0]['status'] for result in results]
+    ['interpolated', 'interpolated', 'interpolated']
+    """
+    if executor is None or not payload:
+        return interpolate_wkbs_z(payload, nodataz, nodataz_tolerance, engine, max_gap, fill_long_gaps)
+    step = -(-len(payload) // max_workers)
+    futures = [
+        executor.submit(
+            interpolate_wkbs_z, payload[start:start + step], nodataz, nodataz_tolerance, engine,
+            max_gap, fill_long_gaps
+        )
+        for start in range(0, len(payload), step)
+    ]
+    try:
+        return [result for future in futures for result in future.result()]
+    finally:
+        # Don't compute the slices that won't be consumed (eg. failure).
+        for future in futures:
+            future.cancel()
+
+
+def chunked(iterable, size, weight=None, max_weight=0):
+    """Split an iterable into lists of at most size items.
+
+    Parameters
+    ----------
+    iterable : iterable
+        Items to split.
+    size : int
+        Maximum number of items per list.
+    weight : callable, optional
+        Function returning the weight of an item (eg. its number of vertices).
+    max_weight : int, optional
+        A list is closed as soon as the sum of the weights of its items
+        reaches this value, no limit if 0.
+
+    Usage
+    -----
+    >>> list(chunked(range(5), 2))
+    [[0, 1], [2, 3], [4]]
+    >>> list(chunked([3, 1, 1, 5, 1], 10, weight=lambda x: x, max_weight=4))
+    [[3, 1], [1, 5], [1]]
+    """
+    chunk = []
+    chunk_weight = 0
+    for item in iterable:
+        chunk.append(item)
+        if weight is not None:
+            chunk_weight += weight(item)
+        if len(chunk) >= size or (max_weight and chunk_weight >= max_weight):
+            yield chunk
+            chunk = []
+            chunk_weight = 0
+    if chunk:
+        yield chunk
+
+
+class DistanceCache:
+    """Least recently used cache of the cumulative distances along line parts.
+
+    The cache is bounded by the total number of distances it holds, the
+    least recently used arrays being evicted first. It can be shared by
+    runs in several threads, its accesses being locked.
+
+    Usage
+    -----
+    >>> cache = DistanceCache(max_values=4)
+    >>> cache.put('a', np.array([0., 1., 2.]))
+    >>> cache.put('b', np.array([0., 5.]))
+    >>> cache.get('a') is None, cache.get('b'), cache.n_values
+    (True, array([0., 5.]), 2)
+    """
+
+    def __init__(self, max_values=1000000):
+        self.max_values = max_values
+        self.arrays = collections.OrderedDict()
+        self.n_values = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return the distances cached for a key, None if not cached."""
+        with self.lock:
+            dist = self.arrays.get(key)
+            if dist is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.arrays.move_to_end(key)
+            return dist
+
+    def put(self, key, dist):
+        with self.lock:
+            if key in self.arrays:
+                self.n_values -= len(self.arrays.pop(key))
+            self.arrays[key] = dist
+            self.n_values += len(dist)
+            while self.n_values > self.max_values:
+                _, evicted = self.arrays.popitem(last=False)
+                self.n_values -= len(evicted)
+
+
+class StageTimer:
+    """Accumulate the wall and CPU times spent in the stages of the processing.
+
+    The CPU time is the one of the whole process, so it includes the
+    other threads.
+
+    Usage
+    -----
+    >>> timer = StageTimer()
+    >>> with timer.stage('read'):
+    ...     _ = sum(range(1000))
+    >>> list(timer.iterate('read', [1, 2]))
+    [1, 2]
+    >>> sorted(timer.as_dict()['read'])
+    ['calls', 'cpu', 'wall']
+    >>> timer.as_dict()['read']['calls']
+    4
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, name, wall, cpu):
+        stage = self.stages.setdefault(name, {'wall': 0., 'cpu': 0., 'calls': 0})
+        stage['wall'] += wall
+        stage['cpu'] += cpu
+        stage['calls'] += 1
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time the code run within the context as a stage."""
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+    def iterate(self, name, iterable):
+        """Yield the items of an iterable, timing how long it takes to get each one."""
+        iterator = iter(iterable)
+        while True:
+            wall, cpu = time.perf_counter(), time.process_time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.add(name, time.perf_counter() - wall, time.process_time() - cpu)
+            yield item
+
+    def as_dict(self):
+        return {name: dict(stage) for name, stage in self.stages.items()}
+
+
+def read_checkpoint(path):
+    """Return the content of a checkpoint file, None if it doesn't exist."""
+    try:
+        with open(path) as checkpoint_file:
+            return json.load(checkpoint_file)
+    except FileNotFoundError:
+        return None
+
+
+def write_checkpoint(path, checkpoint):
+    """Write a checkpoint file atomically, a run killed while writing it leaves the previous one.
+
+    Usage
+    -----
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'checkpoint.json')
+    >>> read_checkpoint(path) is None
+    True
+    >>> write_checkpoint(path, {'last_fid': 10})
+    >>> read_checkpoint(path)
+    {'last_fid': 10}
+    """
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+    os.replace(temp_path, path)
+
+
+# Profilers available to the algorithm, None meaning no profiling.
+PROFILERS = (None, 'cprofile', 'tracemalloc')
+
+
+def cprofile_summary(profiler, limit=20):
+    """Return the functions taking the most cumulative time in a cProfile.Profile.
+
+    Returns
+    -------
+    list
+        Dicts with the keys 'function' (file:line(name)), 'calls',
+        'total_time' (excluding the subcalls) and 'cumulative_time'.
+    """
+    stats = pstats.Stats(profiler).stats
+    rows = [
+        {
+            'function': '{}:{}({})'.format(*function),
+            'calls': n_calls,
+            'total_time': total_time,
+            'cumulative_time': cumulative_time,
+        }
+        for function, (_, n_calls, total_time, cumulative_time, _) in stats.items()
+    ]
+    rows.sort(key=lambda row: row['cumulative_time'], reverse=True)
+    return rows[:limit]
+
+
+def tracemalloc_summary(limit=10):
+    """Return the current and peak memory traced by tracemalloc and the lines allocating the most.
+
+    tracemalloc must be tracing.
+
+    Returns
+    -------
+    dict
+        Keys 'current' and 'peak' (bytes) and 'top', a list of dicts with
+        the keys 'location' (file:line), 'size' (bytes) and 'count'.
+    """
+    current, peak = tracemalloc.get_traced_memory()
+    top = tracemalloc.take_snapshot().statistics('lineno')[:limit]
+    return {
+        'current': current,
+        'peak': peak,
+        'top': [
+            {
+                'location': '{}:{}'.format(stat.traceback[0].filename, stat.traceback[0].lineno),
+                'size': stat.size,
+                'count': stat.count,
+            }
+            for stat in top
+        ],
+    }
+
+
+class LineState:
+    """Sidecar SQLite database of the results of the lines, for the incremental mode.
+
+    Each line is stored with a digest of its input WKB, of the settings of
+    the run and of its anchors, along with its output WKB and statistics.
+    A line whose digest didn't change since the previous run gets its
+    previous result back instead of being interpolated again.
+
+    Usage
+    -----
+    >>> state = LineState(':memory:', 'nodataz=0')
+    >>> wkb = struct.pack('<BII3d3d', 1, 1002, 2, 0, 0, 1, 1, 1, 0)
+    >>> digest = state.digest(wkb)
+    >>> state.store(1, digest, interpolate_wkb_z(wkb, 0))
+    >>> state.flush()
+    >>> buffer, parts, part_stats = state.lookup({1: digest, 2: digest})[1]
+    >>> struct.unpack_from('<6d', buffer, 9), part_stats[0]['status']
+    ((0.0, 0.0, 1.0, 1.0, 1.0, 1.0), 'interpolated')
+    >>> state.lookup({1: state.digest(wkb, anchors=[(2., np.nan)])})
+    {}
+    """
+
+    # Maximum number of variables of an SQLite statement (SQLITE_MAX_VARIABLE_NUMBER).
+    MAX_VARIABLES = 999
+
+    def __init__(self, path, settings_key):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS line_state "
+            "(fid INTEGER PRIMARY KEY, digest BLOB NOT NULL, wkb BLOB NOT NULL, stats TEXT NOT NULL)"
+        )
+        self.settings_key = settings_key.encode()
+        self.pending = []
+        self.reused = 0
+
+    def digest(self, wkb, anchors=None):
+        """Return the digest of a line given its WKB and its anchors."""
+        digest = hashlib.blake2b(self.settings_key, digest_size=16)
+        digest.update(wkb)
+        if anchors is not None:
+            digest.update(repr(anchors).encode())
+        return digest.digest()
+
+    def lookup(self, digests):
+        """Return the previous results of the lines whose digest didn't change.
+
+        Parameters
+        ----------
+        digests : dict
+            Digest of each feature id.
+
+        Returns
+        -------
+        dict
+            Result of each unchanged feature id, in the format of interpolate_wkb_z().
+        """
+        results = {}
+        fids = list(digests)
+        for start in range(0, len(fids), self.MAX_VARIABLES):
+            batch = fids[start:start + self.MAX_VARIABLES]
+            rows = self.connection.execute(
+                "SELECT fid, digest, wkb, stats FROM line_state WHERE fid IN ({})".format(
+                    ','.join('?' * len(batch))
+                ),
+                batch
+            )
+            for fid, digest, wkb, stats in rows:
+                if digest == digests[fid]:
+                    buffer, parts = read_line_wkb(wkb)
+                    results[fid] = (buffer, parts, json.loads(stats))
+        self.reused += len(results)
+        return results
+
+    def store(self, fid, digest, result):
+        """Store the result of a line, written with the next flush()."""
+        buffer, _, part_stats = result
+        self.pending.append((fid, digest, bytes(buffer), json.dumps(part_stats)))
+
+    def flush(self):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO line_state (fid, digest, wkb, stats) VALUES (?, ?, ?, ?)",
+                self.pending
+            )
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+def line_end_values(coords, nodataz, nodataz_tolerance=0.):
+    """Return the Z values at the ends of a line and its first/last valid Z values.
+
+    Parameters
+    ----------
+    coords : numpy.ndarray
+        Coordinates of the vertices as returned by read_line_wkb().
+    nodataz : float or sequence of floats
+        Value(s) used to declare a missing Z value (eg. 0), see missing_z_mask().
+    nodataz_tolerance : float, optional
+        Absolute tolerance when comparing the Z values to the NoData values.
+
+    Returns
+    -------
+    tuple
+        Two elements:
+            - tuple: Z values of the first and last vertices, NaN if missing
+            - tuple: First and last valid Z values, NaN if the line has missing values only.
+
+    Usage
+    -----
+    >>> line_end_values(np.array([[0, 0, 0], [1, 0, 5], [2, 0, 6]]), 0)
+    ((nan, 6.0), (5.0, 6.0))
+    """
+    z = coords[:, 2]
+    missing = missing_z_mask(z, nodataz, nodataz_tolerance)
+    end_z = tuple(np.nan if missing[idx] else float(z[idx]) for idx in (0, -1))
+    if missing.all():
+        return end_z, (np.nan, np.nan)
+    valid_idx = np.flatnonzero(~missing)
+    return end_z, (float(z[valid_idx[0]]), float(z[valid_idx[-1]]))
+
+
+def group_ids(n_items, pairs):
+    """Group items linked by pairs (union-find) and return the group id of each item.
+
+    Usage
+    -----
+    >>> group_ids(5, [(0, 3), (3, 4)])
+    [0, 1, 2, 0, 0]
+    """
+    parents = list(range(n_items))
+
+    def find(item):
+        while parents[item] != item:
+            parents[item] = parents[parents[item]]
+            item = parents[item]
+        return item
+
+    for item_a, item_b in pairs:
+        root_a, root_b = find(item_a), find(item_b)
+        if root_a != root_b:
+            parents[max(root_a, root_b)] = min(root_a, root_b)
+    return [find(item) for item in range(n_items)]
+
+
+def propagate_end_z(end_z, valid_z, end_nodes):
+    """Find Z anchors for the missing ends of lines from the lines sharing these ends.
+
+    The lines form a network whose nodes are their snapped ends. The Z
+    of a node is known when a line has a valid Z value there (the mean
+    is taken if there are several). The missing ends on a known node are
+    anchored with its Z. When no more end can be anchored, the lines with
+    valid values extrapolate their missing ends (flat copy of the first/last
+    valid value) to the unknown nodes, or if there's none, the lines already
+    anchored at their other end. This is repeated until nothing changes.
+
+    Parameters
+    ----------
+    end_z : numpy.ndarray
+        (no. of lines, 2) Z values of the first and last vertices of each line, NaN if missing.
+    valid_z : numpy.ndarray
+        (no. of lines, 2) First and last valid Z values of each line, NaN if
+        the line has missing values only.
+    end_nodes : numpy.ndarray
+        (no. of lines, 2) Node ids of the first and last vertices of each line.
+
+    Returns
+    -------
+    numpy.ndarray
+        (no. of lines, 2) Anchors of the missing ends, NaN where none was found.
+
+    Usage
+    -----
+    A line with missing values only, connected to a line with known ends
+    and to a line whose end connected to it is missing:
+
+    >>> propagate_end_z(
+    ...     end_z=np.array([[1., 2.], [np.nan, np.nan], [np.nan, 5.]]),
+    ...     valid_z=np.array([[1., 2.], [np.nan, np.nan], [4., 5.]]),
+    ...     end_nodes=np.array([[0, 1], [1, 2], [2, 3]]),
+    ... )
+    array([[nan, nan],
+           [ 2.,  4.],
+           [nan, nan]])
+    """
+    anchors = np.full(end_z.shape, np.nan)
+    has_values = ~np.isnan(valid_z[:, 0])
+    node_z = {}
+    for line, side in zip(*np.nonzero(~np.isnan(end_z))):
+        node_z.setdefault(end_nodes[line, side], []).append(end_z[line, side])
+    node_z = {node: float(np.mean(values)) for node, values in node_z.items()}
+    open_ends = {(int(line), int(side)) for line, side in zip(*np.nonzero(np.isnan(end_z)))}
+
+    while open_ends:
+        anchored = {(line, side) for line, side in open_ends if end_nodes[line, side] in node_z}
+        for line, side in anchored:
+            anchors[line, side] = node_z[end_nodes[line, side]]
+        open_ends -= anchored
+        if anchored:
+            continue
+        # Nothing left to anchor, the open ends are extrapolated (and then closed)
+        # and their values shared with their neighbours. The lines with valid
+        # values have the priority over the ones with missing values only.
+        published = {}
+        extrapolated = set()
+        for from_values in (True, False):
+            for line, side in open_ends:
+                if has_values[line] != from_values:
+                    continue
+                value = valid_z[line, side] if from_values else anchors[line, 1 - side]
+                if np.isnan(value):
+                    continue
+                published.setdefault(end_nodes[line, side], []).append(value)
+                extrapolated.add((line, side))
+            if published:
+                break
+        if not published:
+            break
+        open_ends -= extrapolated
+        node_z.update({node: float(np.mean(values)) for node, values in published.items()})
+    return anchors
+
+
+def classify_line_wkb(wkb, nodataz, nodataz_tolerance=0.):
+    """Tell whether a line WKB has missing Z values, without interpolating them.
+
+    Parameters
+    ----------
+    wkb : bytes
+        WKB of a LineString or MultiLineString with a Z dimension.
+    nodataz : float or sequence of floats
+        Value(s) used to declare a missing Z value (eg. 0), see missing_z_mask().
+    nodataz_tolerance : float, optional
+        Absolute tolerance when comparing the Z values to the NoData values.
+
+    Returns
+    -------
+    str
+        'complete' if no Z value is missing, 'missing_only' if all
+        the Z values of a part are missing and none can be interpolated,
+        'interpolated' otherwise (see merge_line_stats()).
+
+    Usage
+    -----
+    >>> classify_line_wkb(struct.pack('<BII3d3d', 1, 1002, 2, 0, 0, 1, 1, 1, 0), 0)
+    'interpolated'
+    """
+    _, parts = read_line_wkb(wkb)
+    statuses = set()
+    for _, _, coords in parts:
+        missing = missing_z_mask(coords[:, 2], nodataz, nodataz_tolerance)
+        if missing.all():
+            statuses.add('missing_only')
+        elif missing.any():
+            return 'interpolated'
+        else:
+            statuses.add('complete')
+    return 'complete' if statuses <= {'complete'} else 'missing_only'
+
+
+def merge_line_stats(part_stats):
+    """Merge the statistics of the parts of a multipart line.
+
+    Parameters
+    ----------
+    part_stats : list
+        Statistics of each part as returned by interpolate_line_z().
+
+    Returns
+    -------
+    dict
+        Statistics of the whole line, the counts being summed and the
+        maximum gap length being the maximum of the parts. The gaps are
+        prefixed by the index of their part. Its status is
+        'interpolated' if any part was interpolated, 'complete' if all the parts
+        are complete, 'long_gap' if a part has gaps left missing and
+        'missing_only' otherwise.
+
+    Usage
+    -----
+    >>> merged = merge_line_stats([
+    ...     interpolate_line_z([0, 1], [0, 0], [1, 1], 0)[1],
+    ...     interpolate_line_z([0, 1, 2], [0, 0, 0], [1, 0, 1], 0)[1],
+    ... ])
+    >>> merged['status'], merged['n_vertices'], merged['gaps']
+    ('interpolated', 5, [[1, 0, 2, 2.0]])
+    """
+    statuses = {stats['status'] for stats in part_stats}
+    if 'interpolated' in statuses:
+        status = 'interpolated'
+    elif statuses <= {'complete'}:
+        status = 'complete'
+    elif 'long_gap' in statuses:
+        status = 'long_gap'
+    else:
+        status = 'missing_only'
+    merged = {'status': status}
+    for key in LineReport.STATS_KEYS:
+        merged[key] = sum(stats[key] for stats in part_stats)
+    merged['max_gap_length'] = max((stats['max_gap_length'] for stats in part_stats), default=0.)
+    merged['gaps'] = [
+        [part_idx] + gap for part_idx, stats in enumerate(part_stats) for gap in stats['gaps']
+    ]
+    return merged
+
+
+def qa_attributes(stats):
+    """Return the values of the QA fields of a line given its statistics.
+
+    The values are, in order: status, number of missing values, number of
+    interpolated values, number of values filled at the ends, maximum
+    gap length and number of gaps longer than the limits. They're all
+    None (NULL) for a feature without geometry.
+
+    Usage
+    -----
+    >>> qa_attributes(interpolate_line_z([0, 1, 2, 3, 4], [0] * 5, [0, 1, 0, 3, 0], 0)[1])
+    ['interpolated', 3, 1, 2, 2.0, 0]
+    """
+    if stats is None:
+        return [None] * 6
+    return [
+        stats['status'], stats['n_missing'], stats['n_interpolated'],
+        stats['n_end_filled'], stats['max_gap_length'], stats['n_long_gaps'],
+    ]
+
+
+class LineReport:
+    """Aggregate how the lines were processed.
+
+    The lines are counted per category, along with a few sample feature
+    ids per category. If a CSV file object is given, a row is also written
+    for each line (after a header row if csv_header is True). The max_gaps longest gaps of all the lines are kept in
+    a heap. The aggregates can be saved with as_dict() and restored with
+    restore(), eg. to resume a run.
+
+    Usage
+    -----
+    >>> report = LineReport(max_samples=1, max_gaps=1)
+    >>> report.add(1, merge_line_stats([interpolate_line_z([0, 1, 2, 3, 4], [0] * 5, [0, 1, 0, 3, 0], 0)[1]]))
+    ['end_filled', 'interpolated']
+    >>> report.counts['end_filled'], report.samples['interpolated'], report.vertices['n_missing']
+    (1, [1], 3)
+    >>> report.longest_gaps()
+    [{'feature_id': 1, 'part': 0, 'start_vertex': 1, 'end_vertex': 3, 'length': 2.0}]
+    >>> resumed = LineReport(max_samples=1, max_gaps=1)
+    >>> resumed.restore(json.loads(json.dumps(report.as_dict())))
+    >>> resumed.longest_gaps() == report.longest_gaps(), resumed.samples == report.samples
+    (True, True)
+    """
+
+    CATEGORIES = ('complete', 'missing_only', 'end_filled', 'interpolated', 'long_gap')
+    STATS_KEYS = ('n_vertices', 'n_missing', 'n_anchored', 'n_end_filled', 'n_interpolated',
+                  'n_left_missing', 'n_long_gaps')
+
+    def __init__(self, max_samples=5, csv_file=None, max_gaps=10, csv_header=True):
+        self.max_samples = max_samples
+        self.max_gaps = max_gaps
+        self.gaps_heap = []
+        self.n_lines = 0
+        self.counts = dict.fromkeys(self.CATEGORIES, 0)
+        self.samples = {category: [] for category in self.CATEGORIES}
+        self.vertices = dict.fromkeys(self.STATS_KEYS, 0)
+        self.csv_writer = None
+        if csv_file is not None:
+            self.csv_writer = csv.writer(csv_file)
+            if csv_header:
+                self.csv_writer.writerow(('feature_id', 'status') + self.STATS_KEYS + ('max_gap_length',))
+
+    @staticmethod
+    def categories(stats):
+        """Return the categories a line falls into given its statistics."""
+        if stats['status'] != 'interpolated':
+            return [stats['status']]
+        return [
+            category for category, key in (
+                ('end_filled', 'n_end_filled'), ('interpolated', 'n_interpolated'), ('long_gap', 'n_long_gaps')
+            )
+            if stats[key]
+        ]
+
+    def add_count(self, category, count, sample_ids=()):
+        """Add to a category lines that weren't processed individually."""
+        self.n_lines += count
+        self.counts[category] += count
+        room = self.max_samples - len(self.samples[category])
+        self.samples[category].extend(list(sample_ids)[:max(room, 0)])
+
+    def add(self, feature_id, stats):
+        """Add a line to the report and return its categories."""
+        self.n_lines += 1
+        categories = self.categories(stats)
+        for category in categories:
+            self.counts[category] += 1
+            if len(self.samples[category]) < self.max_samples:
+                self.samples[category].append(feature_id)
+        for key in self.STATS_KEYS:
+            self.vertices[key] += stats[key]
+        for part_idx, start, stop, length in stats['gaps']:
+            item = (length, feature_id, part_idx, start, stop)
+            if len(self.gaps_heap) < self.max_gaps:
+                heapq.heappush(self.gaps_heap, item)
+            elif self.max_gaps:
+                heapq.heappushpop(self.gaps_heap, item)
+        if self.csv_writer is not None:
+            self.csv_writer.writerow(
+                [feature_id, stats['status']]
+                + [stats[key] for key in self.STATS_KEYS]
+                + [stats['max_gap_length']]
+            )
+        return categories
+
+    def as_dict(self):
+        """Return the aggregates of the lines added so far, serializable to JSON."""
+        return {
+            'n_lines': self.n_lines,
+            'counts': self.counts,
+            'samples': self.samples,
+            'vertices': self.vertices,
+            'gaps': self.gaps_heap,
+        }
+
+    def restore(self, aggregates):
+        """Restore the aggregates returned by as_dict()."""
+        self.n_lines = aggregates['n_lines']
+        self.counts.update(aggregates['counts'])
+        self.samples.update(aggregates['samples'])
+        self.vertices.update(aggregates['vertices'])
+        # The items are still in heap order.
+        self.gaps_heap = [tuple(item) for item in aggregates['gaps']]
+        while len(self.gaps_heap) > self.max_gaps:
+            heapq.heappop(self.gaps_heap)
+
+    def longest_gaps(self):
+        """Return the longest gaps found, from the longest one.
+
+        The gaps are described by the feature id, the index of the part and the
+        indices of the valid vertices around the gap (start_vertex, end_vertex).
+        """
+        return [
+            {'feature_id': feature_id, 'part': part_idx, 'start_vertex': start, 'end_vertex': stop,
+             'length': length}
+            for length, feature_id, part_idx, start, stop in sorted(self.gaps_heap, reverse=True)
+        ]
+
+
+def idx_first_last_valid_items(list_, invalid_item):
+    """Determine the indexes of the first and last valid items in a sequence.
+    
+    Parameters
+    ----------
+    list_ : list
+        A list whose one or both ends has invalid items.
+    invalid_item : float
+        Invalid item that needs to be replaced (eg. 0).
+    
+    Returns
+    -------
+    tuple
+        Two elements:
+            - int: first valid item
+            - int: last valid item
+    
+    Usage
+    -----
+    >>> idx_first_last_valid_items([0, 0, 1, 0, 2, 0], 0)
+    (2, 4)
+    >>> idx_first_last_valid_items([1, 1, 1], 0)
+    (0, 2)
+    """
+    valid_idx = np.flatnonzero(~missing_z_mask(list_, invalid_item))
+    return int(valid_idx[0]), int(valid_idx[-1])
+
+
+def fill_list_ends(list_, invalid_item):
+    """Fill the ends of a list with the first/last valid item found.
+    
+    Parameters
+    ----------
+    list_ : list
+        A list whose one or both ends has invalid items.
+    invalid_item : float
+        Invalid item that needs to be replaced (eg. 0).
+    
+    Returns
+    -------
+    tuple
+        Two elements:
+            - list: Original list with filled ends
+            - int: Number of filled items.
+    
+    Usage
+    -----
+    >>> fill_list_ends([0, 0, 1, 0, 2, 0], 0)
+    ([1, 1, 1, 0, 2, 2], 3)
+    >>> fill_list_ends([0, 0, 0], 0)
+    None
+    >>> fill_list_ends([1, 1, 1], 0)
+    ([1, 1, 1], 0)
+    """
+    values = np.asarray(list_)
+    missing = missing_z_mask(values, invalid_item)
+    # All the items are invalid, we don't know how to fill the new list.
+    if missing.all():
+        return None
+    # These is no invalid item, return the original list.
+    if not missing.any():
+        return list_, 0
+    new_values, no_filled_item = fill_array_ends(values, missing)
+    return new_values.tolist(), no_filled_item
+
+### QGIS ALGORITHM
+
+def linear_geometry(geometry):
+    """Return a line geometry with its curves (eg. CompoundCurve) segmentized.
+
+    The WKB readers only handle the LineString and MultiLineString types.
+    """
+    if QgsWkbTypes.isCurvedType(geometry.wkbType()):
+        return QgsGeometry(geometry.constGet().segmentize())
+    return geometry
+
+
+class BufferedSink:
+    """Buffer the features written to a sink and add them in bulk.
+
+    The features are written with a single call to sink.addFeatures() once
+    buffer_size features are buffered, or once they reach max_vertices
+    vertices (if not 0), and when flush() is called.
+    A write that fails is reported to the user and counted as failed,
+    the following ones are still attempted. After a successful write,
+    on_flush (if given) is called with the id of the last feature written,
+    unless a previous write failed: a checkpoint then never moves past
+    features that weren't written.
+    """
+
+    def __init__(self, sink, buffer_size, feedback, on_flush=None, max_vertices=0):
+        self.sink = sink
+        self.buffer_size = buffer_size
+        self.feedback = feedback
+        self.on_flush = on_flush
+        self.max_vertices = max_vertices
+        self.features = []
+        self.n_vertices = 0
+        self.written = 0
+        self.failed = 0
+
+    def addFeatures(self, features, n_vertices=0):
+        """Buffer the features, n_vertices being their total number of vertices."""
+        self.features.extend(features)
+        self.n_vertices += n_vertices
+        if (len(self.features) >= self.buffer_size
+                or self.max_vertices and self.n_vertices >= self.max_vertices):
+            self.flush()
+
+    def write(self, features):
+        """Write the features at once and return whether it succeeded."""
+        result = self.sink.addFeatures(features, QgsFeatureSink.FastInsert)
+        # A data provider returns a (success, features) tuple in PyQGIS,
+        # which is always true.
+        if isinstance(result, tuple):
+            return result[0]
+        return result
+
+    def last_error(self):
+        # lastError() is only available from QGIS 3.16.
+        return getattr(self.sink, 'lastError', lambda: '')()
+
+    def flush(self):
+        if not self.features:
+            return
+        features, self.features = self.features, []
+        self.n_vertices = 0
+        # The ids may be changed by the sink when the features are added.
+        last_id = features[-1].id()
+        if self.write(features):
+            self.written += len(features)
+            if self.on_flush is not None and not self.failed:
+                self.on_flush(last_id)
+            return
+        # The sink doesn't tell which features were written before the
+        # failure, so the whole write is counted as failed.
+        self.failed += len(features)
+        self.feedback.reportError(
+            QCoreApplication.translate(
+                'Processing', "{count} feature(s) could not be written to the output. {error}"
+            ).format(count=len(features), error=self.last_error())
+        )
+
+
+class BufferedGeometryUpdater(BufferedSink):
+    """Buffer the features whose geometry changed and update them in bulk on a data provider.
+
+    The geometries are changed with a single call to changeGeometryValues(),
+    which the providers run in a single transaction.
+    """
+
+    def write(self, features):
+        return self.sink.changeGeometryValues(
+            {feature.id(): feature.geometry() for feature in features}
+        )
+
+    def last_error(self):
+        return ' '.join(self.sink.errors()[-1:])
+
+
+class BufferedLayerWriter(BufferedSink):
+    """Buffer the features and add them in bulk to the data provider of a layer.
+
+    The fields of the layer may differ from the fields of the features
+    (eg. a GeoPackage adds its fid field first), so the attributes are
+    copied by name, the primary key being left to the provider.
+    Each write is committed by the provider at once.
+    """
+
+    def __init__(self, layer, fields, buffer_size, feedback, on_flush=None):
+        super().__init__(layer.dataProvider(), buffer_size, feedback, on_flush)
+        self.fields = layer.fields()
+        primary_keys = set(self.sink.pkAttributeIndexes())
+        # Index of the attribute of the features copied to each field of the layer.
+        self.mapping = [
+            -1 if index in primary_keys else fields.lookupField(field.name())
+            for index, field in enumerate(self.fields)
+        ]
+
+    def write(self, features):
+        new_features = []
+        for feature in features:
+            attributes = feature.attributes()
+            new_feature = QgsFeature(self.fields)
+            new_feature.setGeometry(feature.geometry())
+            new_feature.setAttributes(
+                [attributes[index] if index >= 0 else None for index in self.mapping]
+            )
+            new_features.append(new_feature)
+        return super().write(new_features)
+
+    def last_error(self):
+        return ' '.join(self.sink.errors()[-1:])
+
+
+# NumPy types of the raster data types read by DemSampler.
+RASTER_DTYPES = {
+    Qgis.Byte: np.uint8,
+    Qgis.UInt16: np.uint16,
+    Qgis.Int16: np.int16,
+    Qgis.UInt32: np.uint32,
+    Qgis.Int32: np.int32,
+    Qgis.Float32: np.float32,
+    Qgis.Float64: np.float64,
+}
+
+
+class DemSampler:
+    """Sample the Z values of a DEM band under the vertices of the lines.
+
+    A single raster block covering the bounding box of a line is read
+    per line, then sampled at every vertex with sample_grid(). The lines
+    are transformed to the CRS of the DEM when it differs. It must be
+    used from the thread running the algorithm, the raster provider not
+    being thread safe.
+    """
+
+    def __init__(self, raster_layer, band, crs, transform_context):
+        self.provider = raster_layer.dataProvider()
+        self.band = band
+        self.extent = raster_layer.extent()
+        self.width = raster_layer.width()
+        self.height = raster_layer.height()
+        self.cell_width = raster_layer.rasterUnitsPerPixelX()
+        self.cell_height = raster_layer.rasterUnitsPerPixelY()
+        self.transform = None
+        if raster_layer.crs() != crs:
+            self.transform = QgsCoordinateTransform(crs, raster_layer.crs(), transform_context)
+        self.nodata = None
+        if self.provider.sourceHasNoDataValue(band) and self.provider.useSourceNoDataValue(band):
+            self.nodata = self.provider.sourceNoDataValue(band)
+
+    def read_block(self, col_min, row_min, col_max, row_max):
+        """Read the cells of a window of the raster, NaN where NoData."""
+        x_min = self.extent.xMinimum() + col_min * self.cell_width
+        y_max = self.extent.yMaximum() - row_min * self.cell_height
+        n_cols = col_max - col_min + 1
+        n_rows = row_max - row_min + 1
+        extent = QgsRectangle(
+            x_min, y_max - n_rows * self.cell_height, x_min + n_cols * self.cell_width, y_max
+        )
+        block = self.provider.block(self.band, extent, n_cols, n_rows)
+        dtype = RASTER_DTYPES.get(block.dataType())
+        if not block.isValid() or dtype is None:
+            return np.full((n_rows, n_cols), np.nan), x_min, y_max
+        grid = np.frombuffer(bytes(block.data()), dtype=dtype).reshape(n_rows, n_cols).astype(float)
+        if self.nodata is not None:
+            grid[grid == self.nodata] = np.nan
+        return grid, x_min, y_max
+
+    def sample(self, geometry):
+        """Return the DEM values under the vertices of each part of a line geometry.
+
+        Returns
+        -------
+        list
+            numpy.ndarray of each part, NaN where the DEM is unknown.
+        """
+        if self.transform is not None:
+            geometry = QgsGeometry(geometry)
+            geometry.transform(self.transform)
+        _, parts = read_line_wkb(bytes(geometry.asWkb()))
+        bbox = geometry.boundingBox()
+        # Window of the cells covering the bounding box, with a margin of one
+        # cell for the bilinear sampling, clipped to the raster.
+        col_min = max(math.floor((bbox.xMinimum() - self.extent.xMinimum()) / self.cell_width) - 1, 0)
+        col_max = min(math.floor((bbox.xMaximum() - self.extent.xMinimum()) / self.cell_width) + 1,
+                      self.width - 1)
+        row_min = max(math.floor((self.extent.yMaximum() - bbox.yMaximum()) / self.cell_height) - 1, 0)
+        row_max = min(math.floor((self.extent.yMaximum() - bbox.yMinimum()) / self.cell_height) + 1,
+                      self.height - 1)
+        if col_min > col_max or row_min > row_max:
+            return [np.full(len(coords), np.nan) for _, _, coords in parts]
+        grid, x_min, y_max = self.read_block(col_min, row_min, col_max, row_max)
+        return [
+            sample_grid(grid, x_min, y_max, self.cell_width, self.cell_height, coords[:, 0], coords[:, 1])
+            for _, _, coords in parts
+        ]
+
+
+class LineDistanceMeter:
+    """Measure the cumulative distances along the parts of the lines in another CRS.
+
+    With a projected CRS, a copy of the geometry is transformed at once and
+    the distances are computed from its coordinates. With a geographic CRS,
+    the segments are measured on its ellipsoid. The output geometries are
+    left in the source CRS.
+
+    The distances are cached on the XY coordinates of the parts, the cache
+    being shared by the runs of the algorithm (eg. with another engine),
+    which may run at the same time in background tasks. A meter must be
+    used from the thread running the algorithm.
+    """
+
+    cache = DistanceCache()
+
+    def __init__(self, source_crs, crs, transform_context):
+        self.key = (source_crs.authid() or source_crs.toWkt(), crs.authid() or crs.toWkt())
+        self.transform = QgsCoordinateTransform(source_crs, crs, transform_context)
+        self.distance_area = None
+        if crs.isGeographic():
+            self.distance_area = QgsDistanceArea()
+            self.distance_area.setSourceCrs(crs, transform_context)
+            self.distance_area.setEllipsoid(crs.ellipsoidAcronym())
+
+    def measure(self, coords):
+        """Return the cumulative distances along the transformed coordinates of a part."""
+        if self.distance_area is None:
+            return cumulative_distances(coords[:, 0], coords[:, 1])
+        points = [QgsPointXY(x, y) for x, y in coords[:, :2].tolist()]
+        seg_lengths = [self.distance_area.measureLine(start, end) for start, end in zip(points, points[1:])]
+        return np.concatenate(([0.], np.cumsum(seg_lengths)))
+
+    def distances(self, geometry):
+        """Return the distances along each part of a line geometry."""
+        _, parts = read_line_wkb(bytes(geometry.asWkb()))
+        keys = [self.key + (hashlib.blake2b(coords[:, :2].tobytes()).digest(),) for _, _, coords in parts]
+        part_distances = [self.cache.get(key) for key in keys]
+        if all(dist is not None for dist in part_distances):
+            return part_distances
+        geometry = QgsGeometry(geometry)
+        try:
+            geometry.transform(self.transform)
+        except QgsCsException as error:
+            raise QgsProcessingException(
+                QCoreApplication.translate(
+                    'Processing', "A line could not be transformed to measure its distances. {error}"
+                ).format(error=error)
+            )
+        _, transformed_parts = read_line_wkb(bytes(geometry.asWkb()))
+        for part_idx, (key, (_, _, coords)) in enumerate(zip(keys, transformed_parts)):
+            if part_distances[part_idx] is None:
+                part_distances[part_idx] = self.measure(coords)
+                self.cache.put(key, part_distances[part_idx])
+        return part_distances
+
+
+class InterpolateMissingZOnLine(QgsProcessingAlgorithm):
+
+    # Constants used to refer to parameters and outputs. They will be
+    # used when calling the algorithm from another algorithm, or when
+    # calling from the QGIS console.
+
+    INPUT = 'INPUT'
+    OUTPUT = 'OUTPUT'
+    NODATAZ = 'NODATAZ'
+    EXTRA_NODATAZ = 'EXTRA_NODATAZ'
+    NODATAZ_TOLERANCE = 'NODATAZ_TOLERANCE'
+    ENGINE = 'ENGINE'
+    DEM = 'DEM'
+    DEM_BAND = 'DEM_BAND'
+    DISTANCE_CRS = 'DISTANCE_CRS'
+    MAX_GAP_DISTANCE = 'MAX_GAP_DISTANCE'
+    MAX_GAP_VERTICES = 'MAX_GAP_VERTICES'
+    FILL_LONG_GAPS = 'FILL_LONG_GAPS'
+    MAX_LONGEST_GAPS = 'MAX_LONGEST_GAPS'
+    EXPLODE = 'EXPLODE'
+    IN_PLACE = 'IN_PLACE'
+    QA_FIELDS = 'QA_FIELDS'
+    FILL_FROM_NEIGHBOURS = 'FILL_FROM_NEIGHBOURS'
+    SNAP_TOLERANCE = 'SNAP_TOLERANCE'
+    VERTICES_ANCHORED = 'VERTICES_ANCHORED'
+    CHUNK_SIZE = 'CHUNK_SIZE'
+    MAX_BATCH_VERTICES = 'MAX_BATCH_VERTICES'
+    WRITE_BUFFER_SIZE = 'WRITE_BUFFER_SIZE'
+    MAX_LINE_MESSAGES = 'MAX_LINE_MESSAGES'
+    REPORT = 'REPORT'
+    STATE = 'STATE'
+    CHECKPOINT = 'CHECKPOINT'
+    RESUME = 'RESUME'
+    PROFILE = 'PROFILE'
+    TIMINGS_REPORT = 'TIMINGS_REPORT'
+    TIMINGS = 'TIMINGS'
+    TOTAL_TIME = 'TOTAL_TIME'
+    VERTICES_PER_SECOND = 'VERTICES_PER_SECOND'
+    LINES_REUSED = 'LINES_REUSED'
+    LINES_COMPLETE = 'LINES_COMPLETE'
+    LINES_MISSING_ONLY = 'LINES_MISSING_ONLY'
+    LINES_END_FILLED = 'LINES_END_FILLED'
+    LINES_INTERPOLATED = 'LINES_INTERPOLATED'
+    LINES_LONG_GAP = 'LINES_LONG_GAP'
+    LONGEST_GAPS = 'LONGEST_GAPS'
+    VERTICES_END_FILLED = 'VERTICES_END_FILLED'
+    VERTICES_INTERPOLATED = 'VERTICES_INTERPOLATED'
+    FEATURES_WRITTEN = 'FEATURES_WRITTEN'
+    FEATURES_FAILED = 'FEATURES_FAILED'
+    PEAK_BATCH_VERTICES = 'PEAK_BATCH_VERTICES'
+    PEAK_BATCH_BYTES = 'PEAK_BATCH_BYTES'
+
+    def tr(self, string):
+        """
+        Returns a translatable string with the self.tr() function.
+        """
+        return QCoreApplication.translate('Processing', string)
+
+    def createInstance(self):
+        return InterpolateMissingZOnLine()
+
+    def name(self):
+        """
+        Returns the algorithm name, used for identifying the algorithm. This
+        string should be fixed for the algorithm, and must not be localised.
+        The name should be unique within each provider. Names should contain
+        lowercase alphanumeric characters only and no spaces or other
+        formatting characters.
+        """
+        return 'interpolate_missing_z_on_line'
+
+    def displayName(self):
+        """
+        Returns the translated algorithm name, which should be used for any
+        user-visible display of the algorithm name.
+        """
+        return self.tr('Interpolate missing Z on line')
+
+    def group(self):
+        """
+        Returns the name of the group this algorithm belongs to. This string
+        should be localised.
+        """
+        return self.tr('External Scripts')
+
+    def groupId(self):
+        """
+        Returns the unique ID of the group this algorithm belongs to. This
+        string should be fixed for the algorithm, and must not be localised.
+        The group id should be unique within each provider. Group id should
+        contain lowercase alphanumeric characters only and no spaces or other
+        formatting characters.
+        """
+        return 'externalscripts'
+
+    def shortHelpString(self):
+        """
+        Returns a localised short helper string for the algorithm. This string
+        should provide a basic description about what the algorithm does and the
+        parameters and outputs associated with it..
+        """
+        return self.tr(
+            "This algorithm interpolates missing Z values on a lineZ layer.\n\n"
+            "QGIS doesn't have a NULL for declaring missing Z values in vector layers. "
+            "A newly created vector layer will have Z values defaulting to 0. "
+            "The parameter 'NoData Z' provides a way to declare what numerical value should "
+            "be considered as the NoData one (0 in most cases). Other NoData values "
+            "can be declared, separated by commas (eg. -9999, nan), and a tolerance "
+            "can be set for comparing the Z values to the NoData values.\n\n"
+            "If the first or last vertices of a line have missing values, the "
+            "algorithm will fill them in (extrapolate) by setting their value "
+            "to the first/last valid ones found.\n\n"
+            "Optionally, the missing line ends are first set with the Z values of "
+            "the ends of the neighbouring lines, snapped within a tolerance. This is "
+            "propagated through the network of lines, so that the lines with missing "
+            "values only can also be filled.\n\n"
+            "The gaps are interpolated along the distance, either linearly or with "
+            "a monotone cubic (PCHIP) that doesn't overshoot the known values. The "
+            "DEM-assisted engine makes the missing values follow a DEM, shifted to "
+            "match the known Z values of the line (the DEM is read once per line).\n\n"
+            "The distances along the lines are measured in the CRS of the layer, "
+            "unless another CRS is set (eg. a projected one for a layer in degrees), "
+            "the distances being ellipsoidal if it's a geographic CRS. The output "
+            "stays in the CRS of the layer.\n\n"
+            "In the incremental mode, the result of each line is stored in a SQLite "
+            "database, and the lines that didn't change since the previous run "
+            "(same geometry and settings) get their previous result back instead "
+            "of being interpolated again.\n\n"
+            "A long run can write checkpoints, each time the buffered features "
+            "are written to a GeoPackage output (or to the input layer in place), "
+            "and be resumed from the last one after it was killed or canceled.\n\n"
+            "The input layer can be updated in place, in which case only the "
+            "lines whose Z values changed are rewritten.\n\n"
+            "Each part of a multipart line is processed separately. The multipart "
+            "lines are kept as they are unless 'Explode multipart lines' is checked.\n\n"
+            "Author: Maxime Liquet"
+        )
+    
+    def helpUrl(self):
+        return "https://github.com/maximlt/qgis_interpolate_missing_z_line"
+
+    def qa_output_fields(self):
+        """Return the QA fields describing how each line was processed."""
+        fields = QgsFields()
+        fields.append(QgsField('z_status', QVariant.String))
+        for name in ('n_missing', 'n_interpolated', 'n_end_filled'):
+            fields.append(QgsField(name, QVariant.Int))
+        fields.append(QgsField('max_gap_length', QVariant.Double))
+        fields.append(QgsField('n_long_gaps', QVariant.Int))
+        return fields
+
+    def report_outputs(self):
+        """Return the names and descriptions of the outputs summarizing the lines processed."""
+        return [
+            (self.LINES_COMPLETE, self.tr('Lines without missing value')),
+            (self.LINES_MISSING_ONLY, self.tr('Lines with missing values only')),
+            (self.LINES_END_FILLED, self.tr('Lines with filled ends')),
+            (self.LINES_INTERPOLATED, self.tr('Lines interpolated')),
+            (self.LINES_LONG_GAP, self.tr('Lines with gaps longer than the limits')),
+            (self.VERTICES_ANCHORED, self.tr('Line ends filled from the neighbouring lines')),
+            (self.VERTICES_END_FILLED, self.tr('Vertices filled at the line ends')),
+            (self.VERTICES_INTERPOLATED, self.tr('Vertices interpolated')),
+        ]
+
+    def initAlgorithm(self, config=None):
+        """
+        Here we define the inputs and output of the algorithm, along
+        with some other properties.
+        """
+        # We add the input vector features source.
+        # The algorithm only works with lines.
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.INPUT,
+                self.tr('Input Line Z layer'),
+                [QgsProcessing.TypeVectorLine]
+            )
+        )
+
+        # From https://gis.stackexchange.com/questions/285570/changing-parameter-values-according-to-other-parameter-choice-in-processing-scri
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                name=self.NODATAZ,
+                description=self.tr('NoData Z'),
+                type=QgsProcessingParameterNumber.Double,
+                defaultValue=0,
+                optional=False,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterString(
+                name=self.EXTRA_NODATAZ,
+                description=self.tr('Other NoData Z values (comma separated, nan for NaN)'),
+                optional=True,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                name=self.NODATAZ_TOLERANCE,
+                description=self.tr('NoData Z tolerance'),
+                type=QgsProcessingParameterNumber.Double,
+                defaultValue=0,
+                minValue=0,
+            )
+        )
+
+        # The gaps are interpolated along the distance, linearly or with a
+        # monotone cubic, or following a DEM shifted to match the valid Z values.
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                name=self.ENGINE,
+                description=self.tr('Interpolation engine'),
+                options=[
+                    self.tr('Linear'),
+                    self.tr('Monotone cubic (PCHIP)'),
+                    self.tr('DEM-assisted'),
+                ],
+                defaultValue=0,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterRasterLayer(
+                name=self.DEM,
+                description=self.tr('DEM (DEM-assisted engine)'),
+                optional=True,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterBand(
+                name=self.DEM_BAND,
+                description=self.tr('DEM band'),
+                defaultValue=1,
+                parentLayerParameterName=self.DEM,
+                optional=True,
+            )
+        )
+        # The distances are measured in the CRS of the layer by default.
+        self.addParameter(
+            QgsProcessingParameterCrs(
+                name=self.DISTANCE_CRS,
+                description=self.tr('CRS in which the distances along the lines are measured'),
+                optional=True,
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                name=self.EXPLODE,
+                description=self.tr('Explode multipart lines into single parts'),
+                defaultValue=False,
+            )
+        )
+
+        # The missing line ends can be filled with the Z values of the ends
+        # of the neighbouring lines, snapped within a tolerance.
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                name=self.FILL_FROM_NEIGHBOURS,
+                description=self.tr('Fill missing line ends from the neighbouring lines'),
+                defaultValue=False,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterDistance(
+                name=self.SNAP_TOLERANCE,
+                description=self.tr('Snapping tolerance between line ends'),
+                parentParameterName=self.INPUT,
+                defaultValue=0,
+                minValue=0,
+            )
+        )
+
+        # The gaps too long to be interpolated reliably are left missing, or only
+        # flagged, and the longest gaps of the layer are reported. The lengths
+        # are measured like the distances, possibly in another CRS than the layer's.
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                name=self.MAX_GAP_DISTANCE,
+                description=self.tr(
+                    'Maximum length of a gap to interpolate, in the units of the CRS of the distances (0: no limit)'
+                ),
+                type=QgsProcessingParameterNumber.Double,
+                defaultValue=0,
+                minValue=0,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                name=self.MAX_GAP_VERTICES,
+                description=self.tr('Maximum number of missing vertices of a gap to interpolate (0: no limit)'),
+                type=QgsProcessingParameterNumber.Integer,
+                defaultValue=0,
+                minValue=0,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                name=self.FILL_LONG_GAPS,
+                description=self.tr('Interpolate the longer gaps anyway (only flag them)'),
+                defaultValue=False,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                name=self.MAX_LONGEST_GAPS,
+                description=self.tr('Number of longest gaps reported'),
+                type=QgsProcessingParameterNumber.Integer,
+                defaultValue=10,
+                minValue=0,
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                name=self.QA_FIELDS,
+                description=self.tr('Add fields describing how each line was processed'),
+                defaultValue=False,
+            )
+        )
+
+        # Logging a message per line is slow with large layers, a summary is
+        # reported instead, optionally with a CSV file detailing each line.
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                name=self.MAX_LINE_MESSAGES,
+                description=self.tr('Maximum number of lines reported individually in the log'),
+                type=QgsProcessingParameterNumber.Integer,
+                defaultValue=100,
+                minValue=0,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                name=self.REPORT,
+                description=self.tr('Report of each line'),
+                fileFilter=self.tr('CSV files (*.csv)'),
+                optional=True,
+                createByDefault=False,
+            )
+        )
+
+        # Incremental mode: the results are stored in a SQLite database that is
+        # reused by the next runs, only the lines that changed are interpolated.
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                name=self.STATE,
+                description=self.tr('State of the lines for the incremental mode'),
+                fileFilter=self.tr('SQLite files (*.sqlite)'),
+                optional=True,
+                createByDefault=False,
+            )
+        )
+
+        # Long runs can be resumed from the last checkpoint, written each time
+        # the buffered features are written to a GeoPackage output.
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+                name=self.CHECKPOINT,
+                description=self.tr('Checkpoint (GeoPackage output or in place only)'),
+                fileFilter=self.tr('JSON files (*.json)'),
+                optional=True,
+                createByDefault=False,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                name=self.RESUME,
+                description=self.tr('Resume from the checkpoint'),
+                defaultValue=False,
+            )
+        )
+
+        # The lines are read and interpolated by chunks.
+        chunk_size_param = QgsProcessingParameterNumber(
+            name=self.CHUNK_SIZE,
+            description=self.tr('Number of lines read per chunk'),
+            type=QgsProcessingParameterNumber.Integer,
+            defaultValue=1000,
+            minValue=1,
+        )
+        # The chunks are also bounded by their number of vertices, so that the
+        # memory used doesn't depend on the size of the lines.
+        max_batch_vertices_param = QgsProcessingParameterNumber(
+            name=self.MAX_BATCH_VERTICES,
+            description=self.tr('Maximum number of vertices per chunk (0: no limit)'),
+            type=QgsProcessingParameterNumber.Integer,
+            defaultValue=0,
+            minValue=0,
+        )
+        # The output features are buffered and added to the sink in bulk.
+        write_buffer_size_param = QgsProcessingParameterNumber(
+            name=self.WRITE_BUFFER_SIZE,
+            description=self.tr('Number of features written at once'),
+            type=QgsProcessingParameterNumber.Integer,
+            defaultValue=1000,
+            minValue=1,
+        )
+        # The time spent in each stage is always measured and returned, the
+        # main pass can also be profiled.
+        profile_param = QgsProcessingParameterEnum(
+            name=self.PROFILE,
+            description=self.tr('Profiler'),
+            options=[
+                self.tr('None'),
+                self.tr('cProfile (functions taking the most time)'),
+                self.tr('tracemalloc (memory allocations)'),
+            ],
+            defaultValue=0,
+        )
+        timings_report_param = QgsProcessingParameterFileDestination(
+            name=self.TIMINGS_REPORT,
+            description=self.tr('Timings and profile'),
+            fileFilter=self.tr('JSON files (*.json)'),
+            optional=True,
+            createByDefault=False,
+        )
+        for param in (chunk_size_param, max_batch_vertices_param,
+                      write_buffer_size_param, profile_param, timings_report_param):
+            param.setFlags(param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+            self.addParameter(param)
+
+        # The lines can be updated in place on the input layer, in which case
+        # only the geometries that changed are rewritten and no output is created.
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                name=self.IN_PLACE,
+                description=self.tr('Update the input layer in place (only the lines that changed)'),
+                defaultValue=False,
+            )
+        )
+
+        # We add a feature sink in which to store our processed features (this
+        # usually takes the form of a newly created vector layer when the
+        # algorithm is run in QGIS). It is not used when updating in place.
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.OUTPUT,
+                self.tr('InterpolatedMissingZ'),
+                optional=True,
+                createByDefault=True,
+            )
+        )
+        for name, description in self.report_outputs():
+            self.addOutput(QgsProcessingOutputNumber(name, description))
+        self.addOutput(
+            QgsProcessingOutputNumber(self.FEATURES_WRITTEN, self.tr('Features written'))
+        )
+        self.addOutput(
+            QgsProcessingOutputNumber(self.FEATURES_FAILED, self.tr('Features that could not be written'))
+        )
+        self.addOutput(
+            QgsProcessingOutputNumber(self.LINES_REUSED, self.tr('Lines unchanged since the previous run'))
+        )
+        self.addOutput(
+            QgsProcessingOutputNumber(self.TOTAL_TIME, self.tr('Total time (seconds)'))
+        )
+        self.addOutput(
+            QgsProcessingOutputNumber(self.VERTICES_PER_SECOND, self.tr('Vertices processed per second'))
+        )
+        self.addOutput(
+            QgsProcessingOutputNumber(self.PEAK_BATCH_VERTICES, self.tr('Vertices in the largest chunk'))
+        )
+        self.addOutput(
+            QgsProcessingOutputNumber(self.PEAK_BATCH_BYTES, self.tr('Size of the geometries of the largest chunk (bytes)'))
+        )
+
+    def scan_lines(self, source, nodataz, nodataz_tolerance, feedback):
+        """Find the lines that need to be processed with a fast scan of their Z values.
+
+        Only the geometries are fetched, their Z values are checked
+        directly on their WKB without interpolating them.
+        Return the ids of the lines to interpolate, the ids of the lines
+        with missing values only and the number of lines without missing value.
+        """
+        feedback.pushInfo(self.tr("Scanning the Z values of the lines..."))
+        interpolate_ids = []
+        missing_only_ids = []
+        n_complete = 0
+        request = QgsFeatureRequest().setNoAttributes()
+        for feature in source.getFeatures(request):
+            if feedback.isCanceled():
+                break
+            if not feature.hasGeometry():
+                continue
+            try:
+                status = classify_line_wkb(
+                    bytes(linear_geometry(feature.geometry()).asWkb()), nodataz, nodataz_tolerance
+                )
+            except ValueError as error:
+                raise self.line_error(feature.id(), error)
+            if status == 'interpolated':
+                interpolate_ids.append(feature.id())
+            elif status == 'missing_only':
+                missing_only_ids.append(feature.id())
+            else:
+                n_complete += 1
+        feedback.pushInfo(
+            self.tr(
+                "{count_interpolate} line(s) to interpolate, {count_missing_only} with missing "
+                "values only, {count_complete} without missing value."
+            ).format(
+                count_interpolate=len(interpolate_ids),
+                count_missing_only=len(missing_only_ids),
+                count_complete=n_complete,
+            )
+        )
+        return interpolate_ids, missing_only_ids, n_complete
+
+    def neighbour_end_anchors(self, source, nodataz, nodataz_tolerance, tolerance, feedback):
+        """Find Z anchors for the missing line ends from the ends of the neighbouring lines.
+
+        The ends of all the lines are read in a first pass and inserted in
+        a spatial index, which is queried once per end to snap together the
+        ends closer than the tolerance. The anchors are then found by
+        propagate_end_z() over the network of the snapped ends.
+        Return a dict mapping the feature ids to the anchors of their parts,
+        only for the features with at least an anchor.
+        """
+        feedback.pushInfo(self.tr("Reading the line ends to find the neighbouring Z values..."))
+        part_keys = []
+        end_xy = []
+        end_z = []
+        valid_z = []
+        # The attributes aren't needed here.
+        request = QgsFeatureRequest().setNoAttributes()
+        for feature in source.getFeatures(request):
+            if feedback.isCanceled():
+                return {}
+            if not feature.hasGeometry():
+                continue
+            try:
+                _, parts = read_line_wkb(bytes(linear_geometry(feature.geometry()).asWkb()))
+            except ValueError as error:
+                raise self.line_error(feature.id(), error)
+            for part_idx, (_, _, coords) in enumerate(parts):
+                # An empty part has no end to snap.
+                if not len(coords):
+                    continue
+                part_end_z, part_valid_z = line_end_values(coords, nodataz, nodataz_tolerance)
+                part_keys.append((feature.id(), part_idx, len(parts)))
+                # Copied, so that the WKB buffer is released.
+                end_xy.extend((tuple(coords[0, :2]), tuple(coords[-1, :2])))
+                end_z.append(part_end_z)
+                valid_z.append(part_valid_z)
+        if not part_keys:
+            return {}
+
+        end_xy = np.array(end_xy, dtype=float)
+        index = QgsSpatialIndex()
+        for end_idx, (x, y) in enumerate(end_xy):
+            index.addFeature(end_idx, QgsRectangle(x, y, x, y))
+        snapped_pairs = []
+        for end_idx, (x, y) in enumerate(end_xy):
+            if feedback.isCanceled():
+                return {}
+            for other_idx in index.intersects(QgsRectangle(x - tolerance, y - tolerance, x + tolerance, y + tolerance)):
+                if other_idx > end_idx and math.hypot(*(end_xy[other_idx] - end_xy[end_idx])) <= tolerance:
+                    snapped_pairs.append((end_idx, other_idx))
+        end_nodes = np.array(group_ids(len(end_xy), snapped_pairs)).reshape(-1, 2)
+
+        anchors = propagate_end_z(np.array(end_z), np.array(valid_z), end_nodes)
+        end_anchors = {}
+        for (feature_id, part_idx, n_parts), part_anchors in zip(part_keys, anchors):
+            # The empty parts, skipped above, have no anchor.
+            feature_anchors = end_anchors.setdefault(feature_id, [(np.nan, np.nan)] * n_parts)
+            feature_anchors[part_idx] = tuple(part_anchors.tolist())
+        end_anchors = {
+            feature_id: feature_anchors for feature_id, feature_anchors in end_anchors.items()
+            if not np.isnan(feature_anchors).all()
+        }
+        feedback.pushInfo(
+            self.tr("{count_lines} line(s) with end(s) anchored on their neighbours.").format(
+                count_lines=len(end_anchors)
+            )
+        )
+        return end_anchors
+
+    def feature_ids(self, source):
+        """Return the ids of all the features, without fetching their geometry nor attributes."""
+        request = QgsFeatureRequest().setNoAttributes().setFlags(QgsFeatureRequest.NoGeometry)
+        return [feature.id() for feature in source.getFeatures(request)]
+
+    def features_by_id(self, source, request, fids, range_size):
+        """Generate the features of the given ids in increasing id order.
+
+        The ids are requested by ranges of range_size ids, each range being
+        sorted in memory: the order doesn't depend on the provider, which
+        would otherwise sort the whole layer in memory to honour an order by.
+        """
+        fids = sorted(fids)
+        for start in range(0, len(fids), range_size):
+            range_request = QgsFeatureRequest(request).setFilterFids(fids[start:start + range_size])
+            yield from sorted(source.getFeatures(range_request), key=lambda feature: feature.id())
+
+    def line_error(self, feature_id, error):
+        """Return the exception stopping the algorithm on a line that can't be read."""
+        return QgsProcessingException(
+            self.tr("The line {fid} could not be read. {error}").format(fid=feature_id, error=error)
+        )
+
+    def interpolate_features(self, features, nodataz, nodataz_tolerance, end_anchors, engine,
+                             max_gap, fill_long_gaps, dem_sampler, distance_meter, state, chunk_size,
+                             max_vertices, timer, feedback):
+        """Generate batches of features along with their interpolation result, in the input order.
+
+        end_anchors maps the feature ids to the anchors of their parts, see
+        neighbour_end_anchors(). The gaps longer than max_gap are left missing unless
+        fill_long_gaps is True, see interpolate_line_z(). With the DEM-assisted engine, the DEM is sampled
+        by dem_sampler under the lines with missing values, before interpolating
+        them. Their distances are measured by distance_meter if given,
+        in the layer CRS otherwise. With a state (incremental mode), the lines that
+        didn't change since the previous run get their previous result back, the
+        other ones are interpolated and their result is stored. The time spent in
+        each stage is accumulated by timer (StageTimer).
+
+        The features are read by chunks of at most chunk_size lines or max_vertices
+        vertices (if not 0), the WKB of their geometry being sent to interpolate_wkbs_z().
+        """
+        vertex_count = None
+        if max_vertices:
+            def vertex_count(feature):
+                return feature.geometry().constGet().nCoordinates() if feature.hasGeometry() else 0
+
+        for chunk in timer.iterate('read', chunked(features, chunk_size, vertex_count, max_vertices)):
+            if feedback.isCanceled():
+                return
+            with timer.stage('read'):
+                # The curves are segmentized, the same geometries being sampled and measured.
+                geometries = [linear_geometry(feature.geometry()) if feature.hasGeometry() else None
+                              for feature in chunk]
+                wkbs = [None if geometry is None else bytes(geometry.asWkb()) for geometry in geometries]
+            digests = {}
+            previous_results = {}
+            if state is not None:
+                with timer.stage('state'):
+                    digests = {
+                        feature.id(): state.digest(wkb, end_anchors.get(feature.id()))
+                        for feature, wkb in zip(chunk, wkbs) if wkb is not None
+                    }
+                    previous_results = state.lookup(digests)
+            payload = []
+            for feature, geometry, wkb in zip(chunk, geometries, wkbs):
+                if feature.id() in previous_results:
+                    continue
+                part_trends = part_distances = None
+                # The raster and the transformations are only used for the
+                # lines that need them, and on this thread.
+                if ((dem_sampler is not None or distance_meter is not None) and wkb is not None
+                        and classify_line_wkb(wkb, nodataz, nodataz_tolerance) != 'complete'):
+                    if dem_sampler is not None:
+                        with timer.stage('dem_sampling'):
+                            part_trends = dem_sampler.sample(geometry)
+                    if distance_meter is not None:
+                        with timer.stage('distances'):
+                            part_distances = distance_meter.distances(geometry)
+                payload.append(
+                    (feature.id(), wkb, end_anchors.get(feature.id()), part_trends, part_distances)
+                )
+            with timer.stage('interpolation'):
+                try:
+                    results = interpolate_wkbs_z(
+                        payload, nodataz, nodataz_tolerance, engine, max_gap, fill_long_gaps
+                    )
+                except ValueError:
+                    # Find the line that couldn't be read.
+                    for fid, wkb, _, _, _ in payload:
+                        try:
+                            if wkb is not None:
+                                read_line_wkb(wkb)
+                        except ValueError as error:
+                            raise self.line_error(fid, error)
+                    raise
+            if state is None:
+                yield list(zip(chunk, results))
+                continue
+            with timer.stage('state'):
+                for (fid, _, _, _, _), result in zip(payload, results):
+                    if result is not None:
+                        state.store(fid, digests[fid], result)
+                state.flush()
+            results = iter(results)
+            yield [
+                (feature, previous_results[feature.id()] if feature.id() in previous_results else next(results))
+                for feature in chunk
             ]
-            # Calculate the distance of each vertex from the starting one (= cumulated segment length).
-            dist = [0] + list(itertools.accumulate(seg_lengths))
-
-            new_zs = []  # To store the new/old Z values.
-
-            # Description of the algorithm:
-            #
-            # The algorithm starts from the first vertex and progresses forward.
-            # When it encounters a valid Z value, it stores it. If the next vertex has
-            # a valid Z value, that value replaces the one stored. If the next vertex
-            # has a missing Z value, the algorithm doesn't progress but looks farther
-            # forward for a valid Z value. It can handle several missing Z values in a row.
-            # Once it has found a valid Z value forward, it uses both valid Z values
-            # to interpolate the Z value at the current location. The interpolation
-            # uses the distance between the valid vertices and the distance between
-            # the first valid vertex and the vertex where the missing value is to
-            # be interpolated.
-
-            # Initialize the index of the end vertex used for interpolating.
-            end_interp_idx = 0
-            # Loop through each vertex.
-            for vert_idx, (current_dist, current_z) in enumerate(zip(dist, base_z_values)):
-                if current_z != nodataz:
-                    # The first encountered Z before a NoDataZ is stored for
-                    # interpolatingthe following adjacent missing values.
-                    start_interp_z = current_z
-                    # Same for the distance.
-                    start_interp_dist = current_dist
-                    # The Z is left unchanged for creating the new line.
-                    new_z = current_z
-                else:
-                    # If the interpolation end vertex needs to be found.
-                    # This is always true for the first vertex with a missing Z value.
-                    if vert_idx >= end_interp_idx:
-                        end_interp_idx = vert_idx + 1
-                        while base_z_values[end_interp_idx] == nodataz:
-                            end_interp_idx += 1
-                        # Retrieve its Z and distance.
-                        end_interp_z = base_z_values[end_interp_idx]
-                        end_interp_dist = dist[end_interp_idx]
-                    # Interpolate the Z value of the vertex being currently processed.
-                    new_z = interpolate_z(
-                        current_dist, start_interp_dist, end_interp_dist, start_interp_z, end_interp_z
+
+    def processAlgorithm(self, parameters, context, feedback):
+        """Here is where the processing itself takes place.
+        
+        Validate the input (could have used prepareAlgorithm() apparently),
+        perform the computation and generate the output.
+        """
+
+        # The input layer to refresh once its geometries are updated in place.
+        self.updated_layer = None
+
+        # Retrieve the feature source and sink. The 'dest_id' variable is used
+        # to uniquely identify the feature sink, and must be included in the
+        # dictionary returned by the processAlgorithm function.
+        source = self.parameterAsSource(
+            parameters,
+            self.INPUT,
+            context
+        )
+
+        # From https://docs.qgis.org/testing/en/docs/user_manual/processing/scripts.html#the-alg-decorator
+        nodataz = self.parameterAsDouble(
+            parameters,
+            'NODATAZ',
+            context
+        )
+        # Other NoData values can be declared (eg. -9999, NaN), they're all
+        # compared at once to the Z values, within a tolerance.
+        try:
+            extra_nodataz = parse_nodataz_values(
+                self.parameterAsString(parameters, self.EXTRA_NODATAZ, context)
+            )
+        except ValueError:
+            raise QgsProcessingException(
+                self.tr("The other NoData Z values must be numbers (or nan) separated by commas.")
+            )
+        nodataz = [nodataz] + extra_nodataz
+        nodataz_tolerance = self.parameterAsDouble(parameters, self.NODATAZ_TOLERANCE, context)
+
+        # If source was not found, throw an exception to indicate that the algorithm
+        # encountered a fatal error. The exception text can be any string, but in this
+        # case we use the pre-built invalidSourceError method to return a standard
+        # helper text for when a source cannot be evaluated
+        if source is None:
+            raise QgsProcessingException(self.invalidSourceError(parameters, self.INPUT))
+
+        # Adapted from https://github.com/qgis/QGIS/blob/master/python/plugins/processing/algs/qgis/GeometryConvert.py
+        if not QgsWkbTypes.hasZ(source.wkbType()):
+            raise QgsProcessingException(self.tr("The input layer has no Z dimension."))
+
+        # The DEM-assisted engine samples the DEM under each line to be processed.
+        engine = ENGINES[self.parameterAsEnum(parameters, self.ENGINE, context)]
+        dem_sampler = None
+        dem_key = None
+        if engine == 'dem':
+            dem = self.parameterAsRasterLayer(parameters, self.DEM, context)
+            if dem is None:
+                raise QgsProcessingException(self.tr("The DEM-assisted engine requires a DEM."))
+            dem_band = self.parameterAsInt(parameters, self.DEM_BAND, context) or 1
+            dem_sampler = DemSampler(dem, dem_band, source.sourceCrs(), context.transformContext())
+            dem_key = (dem.source(), dem_band)
+
+        # The distances along the lines can be measured in another CRS (eg. a
+        # projected one for a layer in degrees), ellipsoidal if it's geographic.
+        distance_meter = None
+        distance_crs = self.parameterAsCrs(parameters, self.DISTANCE_CRS, context)
+        if distance_crs.isValid() and distance_crs != source.sourceCrs():
+            distance_meter = LineDistanceMeter(source.sourceCrs(), distance_crs, context.transformContext())
+
+        # The gaps longer than these limits are left missing, or only flagged.
+        max_gap = (
+            self.parameterAsDouble(parameters, self.MAX_GAP_DISTANCE, context),
+            self.parameterAsInt(parameters, self.MAX_GAP_VERTICES, context),
+        )
+        if not any(max_gap):
+            max_gap = None
+        fill_long_gaps = self.parameterAsBool(parameters, self.FILL_LONG_GAPS, context)
+        max_longest_gaps = self.parameterAsInt(parameters, self.MAX_LONGEST_GAPS, context)
+
+        # In the incremental mode, the results of the lines are stored in a
+        # SQLite database along with a digest of their input and of the settings
+        # changing their result, the lines that didn't change since the previous
+        # run aren't interpolated again.
+        state_path = self.parameterAsFileOutput(parameters, self.STATE, context)
+        settings_key = repr((
+            nodataz, nodataz_tolerance, engine, dem_key,
+            distance_meter.key if distance_meter is not None else None, max_gap, fill_long_gaps,
+        ))
+
+        # Multipart lines are either kept as they are or exploded into
+        # single parts, in which case the output is a single part layer.
+        explode = self.parameterAsBool(parameters, self.EXPLODE, context)
+        explode = explode and QgsWkbTypes.isMultiType(source.wkbType())
+        if explode:
+            output_wkb_type = QgsWkbTypes.singleType(source.wkbType())
+        else:
+            output_wkb_type = source.wkbType()
+
+        # The QA fields are appended to the fields of the input layer, they're
+        # renamed if the input layer already has fields with the same names.
+        qa_fields = self.parameterAsBool(parameters, self.QA_FIELDS, context)
+        fields = source.fields()
+        if qa_fields:
+            fields = QgsProcessingUtils.combineFields(fields, self.qa_output_fields())
+
+        write_buffer_size = self.parameterAsInt(parameters, self.WRITE_BUFFER_SIZE, context)
+        in_place = self.parameterAsBool(parameters, self.IN_PLACE, context)
+
+        # A checkpoint is written each time the buffered features are written, so
+        # that a run that was killed or canceled can be resumed from the next line.
+        checkpoint_path = self.parameterAsFileOutput(parameters, self.CHECKPOINT, context)
+        checkpoint = None
+        if checkpoint_path and self.parameterAsBool(parameters, self.RESUME, context):
+            checkpoint = read_checkpoint(checkpoint_path)
+            if checkpoint is None:
+                feedback.pushInfo(self.tr("No checkpoint found, starting from the first line."))
+            elif checkpoint['settings'] != repr((settings_key, explode, qa_fields, in_place)):
+                raise QgsProcessingException(
+                    self.tr("The checkpoint was written by a run with other settings, it can't be resumed.")
+                )
+            else:
+                feedback.pushInfo(
+                    self.tr("Resuming after the line {fid} ({count} line(s) already processed).").format(
+                        fid=checkpoint['last_fid'], count=checkpoint['report']['n_lines'])
+                )
+
+        if in_place:
+            # Only the geometries that changed are rewritten on the input layer.
+            dest_id = None
+            buffered_sink = self.in_place_updater(
+                parameters, context, explode, qa_fields, write_buffer_size, feedback
+            )
+        elif checkpoint_path:
+            dest_id = self.checkpointed_output(
+                parameters, context, fields, output_wkb_type, source.sourceCrs(), checkpoint
+            )
+            output_layer = QgsVectorLayer(dest_id, 'output', 'ogr')
+            if not output_layer.isValid():
+                raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT))
+            missing_fields = set(fields.names()) - set(output_layer.fields().names())
+            if missing_fields:
+                raise QgsProcessingException(
+                    self.tr("The output {output} has no field {fields}.").format(
+                        output=dest_id, fields=', '.join(sorted(missing_fields)))
+                )
+            buffered_sink = BufferedLayerWriter(output_layer, fields, write_buffer_size, feedback)
+        else:
+            (sink, dest_id) = self.parameterAsSink(
+                parameters,
+                self.OUTPUT,
+                context,
+                fields,
+                output_wkb_type,
+                source.sourceCrs()
+            )
+
+            # If sink was not created, throw an exception to indicate that the algorithm
+            # encountered a fatal error. The exception text can be any string, but in this
+            # case we use the pre-built invalidSinkError method to return a standard
+            # helper text for when a sink cannot be evaluated
+            if sink is None:
+                raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT))
+            buffered_sink = BufferedSink(sink, write_buffer_size, feedback)
+
+        # The time spent in each stage is measured, see StageTimer.
+        timer = StageTimer()
+        run_wall, run_cpu = time.perf_counter(), time.process_time()
+
+        # The missing line ends can be filled from the neighbouring lines, which
+        # requires a first pass over the lines to build the network of line ends.
+
+        end_anchors = {}
+        if self.parameterAsBool(parameters, self.FILL_FROM_NEIGHBOURS, context):
+            tolerance = self.parameterAsDouble(parameters, self.SNAP_TOLERANCE, context)
+            with timer.stage('neighbours'):
+                end_anchors = self.neighbour_end_anchors(
+                    source, nodataz, nodataz_tolerance, tolerance, feedback
+                )
+
+        # When updating in place, the lines without missing value are left
+        # untouched. They're found with a fast scan first so that the main
+        # pass only iterates over the lines that need to be processed. The lines
+        # with missing values only are kept if they're anchored on their neighbours.
+        request = QgsFeatureRequest()
+        feature_count = source.featureCount()
+        fids = None
+        skipped = []
+        if in_place:
+            with timer.stage('scan'):
+                interpolate_ids, missing_only_ids, n_complete = self.scan_lines(
+                    source, nodataz, nodataz_tolerance, feedback
+                )
+            skipped.append(('complete', n_complete, []))
+            interpolate_ids.extend(fid for fid in missing_only_ids if fid in end_anchors)
+            missing_only_ids = [fid for fid in missing_only_ids if fid not in end_anchors]
+            skipped.append(('missing_only', len(missing_only_ids), missing_only_ids))
+            fids = interpolate_ids
+            # Only the geometries are rewritten, the attributes aren't needed.
+            request.setNoAttributes()
+        elif checkpoint_path:
+            with timer.stage('read'):
+                fids = self.feature_ids(source)
+        if checkpoint is not None:
+            fids = [fid for fid in fids if fid > checkpoint['last_fid']]
+        if fids is not None:
+            feature_count = len(fids)
+
+        # Compute the number of steps to display within the progress bar and
+        # get features from source
+        total = 100.0 / feature_count if feature_count else 0
+        chunk_size = self.parameterAsInt(parameters, self.CHUNK_SIZE, context)
+        if checkpoint_path:
+            # The lines up to the checkpoint must be the ones already processed.
+            features = self.features_by_id(source, request, fids, chunk_size)
+        else:
+            if fids is not None:
+                request.setFilterFids(fids)
+            features = source.getFeatures(request)
+
+        max_vertices = self.parameterAsInt(parameters, self.MAX_BATCH_VERTICES, context)
+        # The buffered features are bounded by the same budget as the chunks.
+        buffered_sink.max_vertices = max_vertices
+        max_messages = self.parameterAsInt(parameters, self.MAX_LINE_MESSAGES, context)
+        report_path = self.parameterAsFileOutput(parameters, self.REPORT, context)
+        profiler_name = PROFILERS[self.parameterAsEnum(parameters, self.PROFILE, context)]
+        timings_path = self.parameterAsFileOutput(parameters, self.TIMINGS_REPORT, context)
+
+        feedback.pushInfo(
+            self.tr("Processing {featurecount} line(s)...").format(featurecount=feature_count)
+        )
+        with contextlib.ExitStack() as stack:
+            report_file = None
+            resume_report = (report_path and checkpoint is not None
+                             and checkpoint.get('report_offset') is not None and os.path.exists(report_path))
+            if resume_report:
+                # The rows written after the checkpoint are dropped, their lines being processed again.
+                report_file = stack.enter_context(open(report_path, 'r+', newline=''))
+                report_file.truncate(checkpoint['report_offset'])
+                report_file.seek(checkpoint['report_offset'])
+            elif report_path:
+                report_file = stack.enter_context(open(report_path, 'w', newline=''))
+            report = LineReport(csv_file=report_file, max_gaps=max_longest_gaps, csv_header=not resume_report)
+            if checkpoint is not None:
+                # The lines skipped by the scan were counted by the first run.
+                report.restore(checkpoint['report'])
+                skipped = []
+            for category, count, sample_ids in skipped:
+                report.add_count(category, count, sample_ids)
+            if checkpoint_path:
+                def save_checkpoint(last_fid):
+                    report_offset = None
+                    if report_file is not None:
+                        report_file.flush()
+                        report_offset = report_file.tell()
+                    write_checkpoint(checkpoint_path, {
+                        'last_fid': last_fid,
+                        'output': dest_id,
+                        'settings': repr((settings_key, explode, qa_fields, in_place)),
+                        'report': report.as_dict(),
+                        'report_offset': report_offset,
+                    })
+                buffered_sink.on_flush = save_checkpoint
+            state = None
+            if state_path:
+                try:
+                    state = LineState(state_path, settings_key)
+                except sqlite3.Error as error:
+                    raise QgsProcessingException(
+                        self.tr("The state database {path} could not be opened: {error}").format(
+                            path=state_path, error=error)
                     )
-                # Add the Z values.
-                new_zs.append(new_z)
+                stack.callback(state.close)
+            # The main pass can be profiled.
+            profile = None
+            if profiler_name == 'cprofile':
+                # cProfile.Profile is a context manager from Python 3.8 only.
+                profiler = cProfile.Profile()
+                profiler.enable()
+                stack.callback(profiler.disable)
+            elif profiler_name == 'tracemalloc':
+                tracemalloc.start()
+                stack.callback(tracemalloc.stop)
+            batches = stack.enter_context(contextlib.closing(
+                self.interpolate_features(
+                    features, nodataz, nodataz_tolerance, end_anchors, engine, max_gap,
+                    fill_long_gaps, dem_sampler, distance_meter, state, chunk_size, max_vertices, timer,
+                    feedback
+                )
+            ))
+            # The buffered features are flushed even if the algorithm is canceled or fails.
+            stack.callback(buffered_sink.flush)
+            peak_vertices, peak_bytes = self.write_features(
+                batches, buffered_sink, explode, qa_fields, in_place, total, report, max_messages,
+                timer, feedback
+            )
+            with timer.stage('write'):
+                buffered_sink.flush()
+            if profiler_name == 'tracemalloc':
+                profile = tracemalloc_summary()
+        if profiler_name == 'cprofile':
+            profile = cprofile_summary(profiler)
+
+        timings = self.timings(
+            timer, time.perf_counter() - run_wall, time.process_time() - run_cpu, report, profile
+        )
+        self.report_timings(timings, feedback)
+        if timings_path:
+            with open(timings_path, 'w') as timings_file:
+                json.dump(timings, timings_file, indent=2)
+
+        self.report_summary(report, feedback)
+        if state is not None:
+            feedback.pushInfo(
+                self.tr("{count} line(s) unchanged since the previous run, not interpolated again.").format(
+                    count=state.reused)
+            )
+
+        if buffered_sink.failed:
+            feedback.reportError(
+                self.tr(
+                    "{failed} feature(s) out of {total} could not be written to the output."
+                ).format(failed=buffered_sink.failed, total=buffered_sink.written + buffered_sink.failed)
+            )
+            if checkpoint_path:
+                feedback.reportError(
+                    self.tr("The checkpoint stopped before the first failed write, resume the run to retry it.")
+                )
+        if in_place:
+            feedback.pushInfo(
+                self.tr("{count} line(s) updated in place.").format(count=buffered_sink.written)
+            )
+            if buffered_sink.written:
+                self.updated_layer = self.parameterAsVectorLayer(parameters, self.INPUT, context)
+
+        feedback.pushInfo(
+            self.tr(
+                "Largest chunk: {vertices} vertices, {size} bytes of geometries."
+            ).format(vertices=peak_vertices, size=peak_bytes)
+        )
+
+        # Return the results of the algorithm. In this case our only result is
+        # the feature sink which contains the processed features, but some
+        # algorithms may return multiple feature sinks, calculated numeric
+        # statistics, etc. These should all be included in the returned
+        # dictionary, with keys matching the feature corresponding parameter
+        # or output names.
+        return {
+            self.OUTPUT: dest_id,
+            self.LINES_COMPLETE: report.counts['complete'],
+            self.LINES_MISSING_ONLY: report.counts['missing_only'],
+            self.LINES_END_FILLED: report.counts['end_filled'],
+            self.LINES_INTERPOLATED: report.counts['interpolated'],
+            self.LINES_LONG_GAP: report.counts['long_gap'],
+            self.LONGEST_GAPS: report.longest_gaps(),
+            self.VERTICES_ANCHORED: report.vertices['n_anchored'],
+            self.VERTICES_END_FILLED: report.vertices['n_end_filled'],
+            self.VERTICES_INTERPOLATED: report.vertices['n_interpolated'],
+            self.REPORT: report_path or None,
+            self.FEATURES_WRITTEN: buffered_sink.written,
+            self.FEATURES_FAILED: buffered_sink.failed,
+            self.STATE: state_path or None,
+            self.CHECKPOINT: checkpoint_path or None,
+            self.LINES_REUSED: state.reused if state is not None else 0,
+            self.TOTAL_TIME: timings['wall'],
+            self.VERTICES_PER_SECOND: timings['vertices_per_second'],
+            self.TIMINGS: timings,
+            self.TIMINGS_REPORT: timings_path or None,
+            self.PEAK_BATCH_VERTICES: peak_vertices,
+            self.PEAK_BATCH_BYTES: peak_bytes,
+        }
+
+    def postProcessAlgorithm(self, context, feedback):
+        """Refresh the input layer whose geometries were updated in place.
+
+        The geometries were changed through its data provider, so the layer,
+        its extent and its canvas are reloaded (from the main thread).
+        """
+        if self.updated_layer is not None:
+            self.updated_layer.reload()
+            self.updated_layer.updateExtents()
+            self.updated_layer.triggerRepaint()
+        return {}
 
-            # Dev check to see whether the algo worked correctly.
-            if len(new_zs) != len(base_z_values):
+    def checkpointed_output(self, parameters, context, fields, wkb_type, crs, checkpoint):
+        """Return the destination of a GeoPackage output that can be resumed.
+
+        The output layer is created empty, unless a run is resumed from a
+        checkpoint, in which case its output layer is reused. The features
+        are then added through the data provider of the layer.
+        """
+        if checkpoint is not None:
+            dest_id = checkpoint['output']
+            if not os.path.exists(dest_id.split('|')[0]):
                 raise QgsProcessingException(
-                    self.tr(
-                        "Problem with the code itself: "
-                        "The count of interpolated vertices is different than the original count."
+                    self.tr("The output {output} of the checkpoint doesn't exist anymore.").format(
+                        output=dest_id)
+                )
+            return dest_id
+        destination = self.parameterAsOutputLayer(parameters, self.OUTPUT, context)
+        if not destination.split('|')[0].lower().endswith('.gpkg'):
+            raise QgsProcessingException(self.tr("The checkpoints require a GeoPackage output file."))
+        sink, dest_id = self.parameterAsSink(parameters, self.OUTPUT, context, fields, wkb_type, crs)
+        if sink is None:
+            raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT))
+        # Close the file, the features are then added through a layer.
+        del sink
+        return dest_id
+
+    def in_place_updater(self, parameters, context, explode, qa_fields, buffer_size, feedback):
+        """Return the buffered updater of the geometries of the input layer.
+
+        Check beforehand that the input layer can be updated in place.
+        """
+        layer = self.parameterAsVectorLayer(parameters, self.INPUT, context)
+        if layer is None:
+            raise QgsProcessingException(self.tr("Only a layer can be updated in place."))
+        if explode:
+            raise QgsProcessingException(self.tr("Multipart lines can't be exploded in place."))
+        # The edits would bypass the edit buffer of the layer.
+        if layer.isEditable():
+            raise QgsProcessingException(
+                self.tr("The input layer is being edited, save or discard the edits first.")
+            )
+        provider = layer.dataProvider()
+        if not provider.capabilities() & QgsVectorDataProvider.ChangeGeometries:
+            raise QgsProcessingException(
+                self.tr("The geometries of the input layer can't be changed.")
+            )
+        if qa_fields:
+            feedback.reportError(self.tr("The QA fields aren't added when updating in place."))
+        feedback.pushInfo(
+            self.tr("Updating the lines of {layer} in place.").format(layer=layer.name())
+        )
+        return BufferedGeometryUpdater(provider, buffer_size, feedback)
+
+    def write_features(self, batches, sink, explode, qa_fields, changed_only, total, report,
+                       max_messages, timer, feedback):
+        """Report how each line was processed and write the lines to the sink.
+
+        If changed_only is True, only the lines whose Z values changed are written.
+
+        Each line is added to the report, only the first max_messages lines
+        are reported individually in the log.
+
+        The features of each batch are passed to the buffered sink and the batch
+        is then released, the memory used is then bounded by the size of the batches
+        and by the vertex budget of the sink.
+        Return the number of vertices and the size of the geometries (bytes)
+        of the largest batch.
+        """
+        peak_vertices = peak_bytes = 0
+        current = 0
+        progress = -1
+        # The lines reported individually are counted apart from the report,
+        # which also counts the lines skipped by the scan or before a checkpoint.
+        n_messages = 0
+        # Looping through all the lines found in the layer. In QGIS 3 shapefiles
+        # containing lines are MultiLineStrings, each part of a multipart
+        # line is processed separately.
+        for batch in batches:
+            new_features = []
+            new_vertices = batch_vertices = batch_bytes = 0
+            for feature, result in batch:
+                # Stop the algorithm if cancel button is clicked
+                if feedback.isCanceled():
+                    break
+                stats = None
+                if result is not None:
+                    buffer, _, part_stats = result
+                    batch_vertices += sum(stats['n_vertices'] for stats in part_stats)
+                    batch_bytes += len(buffer)
+                    stats = merge_line_stats(part_stats)
+                    report.add(feature.id(), stats)
+                    n_messages += 1
+                    if n_messages <= max_messages:
+                        self.report_line(feature, stats, feedback)
+                    elif n_messages == max_messages + 1:
+                        feedback.pushInfo(
+                            self.tr("The following lines are not reported individually, see the summary.")
                         )
+                if not changed_only or (stats is not None and stats['status'] == 'interpolated'):
+                    with timer.stage('geometry_rebuild'):
+                        new_features.extend(self.output_features(feature, result, stats, explode, qa_fields))
+                    if stats is not None:
+                        new_vertices += stats['n_vertices']
+                current += 1
+            # Add the features in the sink
+            with timer.stage('write'):
+                sink.addFeatures(new_features, new_vertices)
+            peak_vertices = max(peak_vertices, batch_vertices)
+            peak_bytes = max(peak_bytes, batch_bytes)
+
+            # Update the progress bar, only when the percentage changes
+            if int(current * total) != progress:
+                progress = int(current * total)
+                feedback.setProgress(progress)
+            if feedback.isCanceled():
+                break
+        return peak_vertices, peak_bytes
+
+    def report_summary(self, report, feedback):
+        """Report to the user a summary table of how the lines were processed."""
+        labels = {
+            'complete': self.tr('No missing value, left as is'),
+            'missing_only': self.tr('Missing values only, left as is'),
+            'end_filled': self.tr('End(s) filled with the first/last valid Z'),
+            'interpolated': self.tr('Missing values interpolated'),
+            'long_gap': self.tr('Gap(s) longer than the limits'),
+        }
+        rows = [(self.tr('Category'), self.tr('Lines'), self.tr('Sample feature ids'))]
+        for category in LineReport.CATEGORIES:
+            samples = ', '.join(str(feature_id) for feature_id in report.samples[category])
+            if report.counts[category] > len(report.samples[category]):
+                samples += ', ...'
+            rows.append((labels[category], str(report.counts[category]), samples))
+        widths = [max(len(row[col]) for row in rows) for col in range(2)]
+        feedback.pushInfo(
+            self.tr(
+                "Summary of the {count_lines} line(s) processed "
+                "({count_end_filled} vertices filled at the ends, {count_interpolated} interpolated):"
+            ).format(
+                count_lines=report.n_lines,
+                count_end_filled=report.vertices['n_end_filled'],
+                count_interpolated=report.vertices['n_interpolated'],
+            )
+        )
+        for label, count, samples in rows:
+            feedback.pushInfo(
+                "{}  {}  {}".format(label.ljust(widths[0]), count.rjust(widths[1]), samples).rstrip()
+            )
+        if report.vertices['n_anchored']:
+            feedback.pushInfo(
+                self.tr("{count_anchored} line end(s) set with the Z of the neighbouring lines.").format(
+                    count_anchored=report.vertices['n_anchored']
+                )
+            )
+        longest_gaps = report.longest_gaps()
+        if longest_gaps:
+            feedback.pushInfo(self.tr("Longest gaps (feature id, part, vertices around the gap, length):"))
+            for gap in longest_gaps:
+                feedback.pushInfo(
+                    "  {feature_id}  {part}  {start_vertex}-{end_vertex}  {length:.2f}".format(**gap)
+                )
+
+    def timings(self, timer, wall, cpu, report, profile):
+        """Return the timings of the run, its throughput and its profile (None if not profiled)."""
+        return {
+            'wall': wall,
+            'cpu': cpu,
+            'lines': report.n_lines,
+            'vertices': report.vertices['n_vertices'],
+            'lines_per_second': report.n_lines / wall if wall else 0.,
+            'vertices_per_second': report.vertices['n_vertices'] / wall if wall else 0.,
+            'stages': timer.as_dict(),
+            'profile': profile,
+        }
+
+    def report_timings(self, timings, feedback):
+        """Report to the user the time spent in each stage and the throughput."""
+        feedback.pushInfo(
+            self.tr(
+                "Processed in {wall:.2f} s (CPU {cpu:.2f} s): {lines:,.0f} lines/s, {vertices:,.0f} vertices/s."
+            ).format(
+                wall=timings['wall'], cpu=timings['cpu'],
+                lines=timings['lines_per_second'], vertices=timings['vertices_per_second'],
+            )
+        )
+        for name, stage in sorted(timings['stages'].items(), key=lambda item: -item[1]['wall']):
+            feedback.pushInfo(
+                "  {:<18} {:>9.3f} s  (CPU {:.3f} s)".format(name, stage['wall'], stage['cpu'])
+            )
+        profile = timings['profile']
+        if isinstance(profile, list):
+            feedback.pushInfo(self.tr("Functions taking the most time (cumulative):"))
+            for row in profile[:10]:
+                feedback.pushInfo("  {:>9.3f} s  {}".format(row['cumulative_time'], row['function']))
+        elif isinstance(profile, dict):
+            feedback.pushInfo(
+                self.tr("Memory traced: {peak:,} bytes at the peak. Largest allocations:").format(
+                    peak=profile['peak'])
+            )
+            for row in profile['top']:
+                feedback.pushInfo("  {:>12,} bytes  {}".format(row['size'], row['location']))
+
+    def report_line(self, feature, stats, feedback):
+        """Report to the user how a line was processed."""
+        if stats['status'] == 'complete':
+            # Do not do anything special with a line if it does not contain any NoData Z.
+            # So it's just copied to the output (=sink).
+            # Yet, report is as a warning to the user.
+            feedback.reportError(
+                self.tr(
+                    "Line {feature_id}: Left unchanched as it has no vertex with missing value."
+                ).format(feature_id=feature.id())
+            )
+        elif stats['status'] == 'missing_only':
+            # A line that would contain only NoData Z is considered as okayish
+            # and doesn't stop the algorithm. It's also copied to the output.
+            # It is notified to the user though through an error message that
+            # doesn't stop the algorithm.
+            feedback.reportError(
+                self.tr(
+                    "Line {feature_id}: Contains missing values only, left as is."
+                ).format(feature_id=feature.id())
+            )
+        elif stats['status'] == 'long_gap':
+            feedback.reportError(
+                self.tr(
+                    "Line {feature_id}: {count_long_gaps} gap(s) longer than the limits left missing, left as is."
+                ).format(feature_id=feature.id(), count_long_gaps=stats['n_long_gaps'])
+            )
+        else:
+            # The missing ends of a line can be set with the Z of the
+            # neighbouring lines.
+            if stats['n_anchored']:
+                feedback.pushInfo(
+                    self.tr(
+                        "Line {feature_id}: {count_anchored} end(s) set with the Z of the neighbouring lines."
+                    ).format(feature_id=feature.id(), count_anchored=stats['n_anchored'])
+                )
+
+            # The start and the end vertices of a line can have missing values.
+            # Their values are filled with the closest (in terms of indexes, not geographically)
+            # non missing value.
+            if stats['n_end_filled']:
+                feedback.reportError(
+                    self.tr(
+                        "Line {feature_id}: Has one or both end(s) with missing Z values. "
+                        "{no_filled_vertices} vertices set with the first/last valid Z value(s) found."
+                    ).format(feature_id=feature.id(), no_filled_vertices=stats['n_end_filled'])
                 )
 
+            # The remaining missing values are linearly interpolated by
+            # interpolate_line_z() based on the distance along the line,
+            # between the previous and the next valid vertices.
             feedback.pushInfo(
                 self.tr(
-                    "Line {feature_id}: {count_missing_z} vertices with missing"
+                    "Line {feature_id}: {count_missing_z} vertices with missing "
                     "values interpolated (total no. of vertices: {count_vertices})."
                 ).format(
                     feature_id=feature.id(),
-                    count_missing_z=base_z_values.count(nodataz),
-                    count_vertices=len(base_z_values)
+                    count_missing_z=stats['n_interpolated'],
+                    count_vertices=stats['n_vertices']
                 )
             )
 
-            # The new lines are created with the original, filled and interpolated points.
-            new_pt = []
-            for pt, new_z in zip(line, new_zs):
-                pt.setZ(new_z)
-                new_pt.append(pt)
-            new_line = QgsGeometry.fromPolyline(new_pt)
+    def output_features(self, feature, result, stats, explode, qa_fields):
+        """Return the feature(s) to write to the sink for a processed line.
+
+        If qa_fields is True, the QA attributes (see qa_attributes()) are
+        appended to the attributes of the feature(s).
+        """
+        # A feature without geometry is just copied to the output.
+        if result is None:
+            if not qa_fields:
+                return [feature]
             feat = QgsFeature(feature)
-            feat.setGeometry(new_line)
+            feat.setAttributes(feature.attributes() + qa_attributes(None))
+            return [feat]
+        # The vertices were read from the WKB of the geometry, whose Z values
+        # were patched in place. The new lines are created from the patched WKB,
+        # the XY(M) values are left untouched. When exploded, each part of a
+        # multipart line is a complete LineString WKB.
+        buffer, parts, part_stats = result
+        if explode:
+            new_wkbs = [buffer[start:stop] for start, stop, _ in parts]
+            new_stats = part_stats
+        elif stats['status'] == 'interpolated':
+            new_wkbs = [buffer]
+            new_stats = [stats]
+        elif not qa_fields:
+            return [feature]
+        else:
+            new_wkbs = [None]
+            new_stats = [stats]
+        new_features = []
+        for wkb, wkb_stats in zip(new_wkbs, new_stats):
+            feat = QgsFeature(feature)
+            if wkb is not None:
+                new_line = QgsGeometry()
+                new_line.fromWkb(bytes(wkb))
+                feat.setGeometry(new_line)
+            if qa_fields:
+                feat.setAttributes(feature.attributes() + qa_attributes(wkb_stats))
+            new_features.append(feat)
+        return new_features
 
-            # Add a feature in the sink
-            sink.addFeature(feat, QgsFeatureSink.FastInsert)
 
-            # Update the progress bar
-            feedback.setProgress(int(current * total))
+### COMMAND LINE
 
-        # Return the results of the algorithm. In this case our only result is
-        # the feature sink which contains the processed features, but some
-        # algorithms may return multiple feature sinks, calculated numeric
-        # statistics, etc. These should all be included in the returned
-        # dictionary, with keys matching the feature corresponding parameter
-        # or output names.
-        return {self.OUTPUT: dest_id}
+def interpolate_missing_z_file(input_path, output_path, nodataz=0., nodataz_tolerance=0., engine='linear',
+                               explode=False, layer_name=None, driver_name=None, executor=None,
+                               max_workers=1, chunk_size=1000, max_gap=None, fill_long_gaps=False,
+                               overwrite=False):
+    """Interpolate the missing Z values of a line Z layer of a file (eg. GeoPackage, Shapefile).
+
+    This runs without QGIS (no QgsApplication nor Processing), the features
+    being read and written with OGR (GDAL Python bindings).
+
+    Parameters
+    ----------
+    input_path : str
+        Path of the input file.
+    output_path : str
+        Path of the output file, created with the same driver as the input
+        one unless driver_name is given.
+    nodataz : float or sequence of floats, optional
+        Value(s) used to declare a missing Z value, see missing_z_mask().
+    nodataz_tolerance : float, optional
+        Absolute tolerance when comparing the Z values to the NoData values.
+    engine : str, optional
+        'linear' or 'pchip', see interpolate_line_z().
+    explode : bool, optional
+        Whether to explode the multipart lines into single parts.
+    layer_name : str, optional
+        Layer of the input file to process, the first one if not given.
+    driver_name : str, optional
+        OGR driver of the output file (eg. 'GPKG').
+    executor : concurrent.futures.Executor, optional
+        Executor of the worker threads or processes (it can be reused for several files).
+    max_workers : int, optional
+        Number of workers of the executor.
+    chunk_size : int, optional
+        Number of lines read per chunk.
+    max_gap : tuple, optional
+        Limits of the gaps, see interpolate_line_z().
+    fill_long_gaps : bool, optional
+        Whether to interpolate the gaps longer than max_gap anyway.
+    overwrite : bool, optional
+        Whether to replace an existing output file, a ValueError being
+        raised otherwise.
+
+    Returns
+    -------
+    LineReport
+        How the lines were processed.
+    """
+    # OGR is only needed by the command line, not by the Processing algorithm.
+    from osgeo import ogr
+    ogr.UseExceptions()
+
+    if engine not in ('linear', 'pchip'):
+        raise ValueError("The engine must be 'linear' or 'pchip' outside of QGIS, not {!r}.".format(engine))
+    input_ds = ogr.Open(str(input_path))
+    input_layer = input_ds.GetLayerByName(layer_name) if layer_name else input_ds.GetLayer(0)
+    if input_layer is None:
+        raise ValueError("The layer {!r} wasn't found in {}.".format(layer_name, input_path))
+    geom_type = input_layer.GetGeomType()
+    if not ogr.GT_HasZ(geom_type):
+        raise ValueError("The layer of {} has no Z dimension.".format(input_path))
+    # The curves are segmentized, the output layer having the linear type.
+    geom_type = ogr.GT_GetLinear(geom_type)
+    # OGR reports the Shapefile layers as LineString even when they hold
+    # MultiLineStrings, each feature being exploded after its own WKB type.
+    explode = explode and ogr.GT_Flatten(geom_type) in (ogr.wkbLineString, ogr.wkbMultiLineString)
+    if explode:
+        geom_type = ogr.GT_SetModifier(ogr.wkbLineString, ogr.GT_HasZ(geom_type), ogr.GT_HasM(geom_type))
+
+    driver = ogr.GetDriverByName(driver_name) if driver_name else input_ds.GetDriver()
+    # The drivers don't create a file over an existing one (eg. GeoPackage).
+    if os.path.exists(str(output_path)):
+        if not overwrite:
+            raise ValueError("The output {} already exists.".format(output_path))
+        driver.DeleteDataSource(str(output_path))
+    output_ds = driver.CreateDataSource(str(output_path))
+    output_layer = output_ds.CreateLayer(
+        input_layer.GetName(), input_layer.GetSpatialRef(), geom_type
+    )
+    input_defn = input_layer.GetLayerDefn()
+    for idx in range(input_defn.GetFieldCount()):
+        output_layer.CreateField(input_defn.GetFieldDefn(idx))
+    output_defn = output_layer.GetLayerDefn()
+
+    report = LineReport()
+    for chunk in chunked(input_layer, chunk_size):
+        payload = []
+        for feature in chunk:
+            geometry = feature.GetGeometryRef()
+            if geometry is not None and ogr.GT_IsNonLinear(geometry.GetGeometryType()):
+                geometry = geometry.GetLinearGeometry()
+            wkb = bytes(geometry.ExportToIsoWkb()) if geometry is not None else None
+            payload.append((feature.GetFID(), wkb, None, None, None))
+        results = interpolate_payload(
+            payload, nodataz, nodataz_tolerance, engine, executor, max_workers, max_gap, fill_long_gaps
+        )
+        # A transaction per chunk, writing one feature at a time being slow with GeoPackage.
+        output_layer.StartTransaction()
+        for feature, result in zip(chunk, results):
+            if result is None:
+                new_wkbs = [None]
+            else:
+                buffer, parts, part_stats = result
+                report.add(feature.GetFID(), merge_line_stats(part_stats))
+                if explode:
+                    new_wkbs = [buffer[start:stop] for start, stop, _ in parts]
+                else:
+                    new_wkbs = [buffer]
+            for wkb in new_wkbs:
+                new_feature = ogr.Feature(output_defn)
+                new_feature.SetFrom(feature)
+                if wkb is not None:
+                    new_feature.SetGeometry(ogr.CreateGeometryFromWkb(bytes(wkb)))
+                output_layer.CreateFeature(new_feature)
+        output_layer.CommitTransaction()
+    output_ds = None
+    return report
+
+
+def main(argv=None):
+    """Command line entry point, processing several files in a single process."""
+    parser = argparse.ArgumentParser(
+        description="Interpolate the missing Z values of line Z layers (GeoPackage, Shapefile...) without QGIS."
+    )
+    parser.add_argument('inputs', nargs='+', help="Input files.")
+    parser.add_argument('--output-dir', required=True, help="Directory of the output files (same names).")
+    parser.add_argument('--nodataz', default='0',
+                        help="NoData Z value(s), separated by commas (eg. 0,-9999,nan). Default: 0.")
+    parser.add_argument('--nodataz-tolerance', type=float, default=0.,
+                        help="Tolerance when comparing the Z values to the NoData values.")
+    parser.add_argument('--engine', choices=('linear', 'pchip'), default='linear',
+                        help="Interpolation engine. Default: linear.")
+    parser.add_argument('--max-gap-distance', type=float, default=0.,
+                        help="Maximum length of a gap to interpolate, 0 for no limit.")
+    parser.add_argument('--max-gap-vertices', type=int, default=0,
+                        help="Maximum number of missing vertices of a gap to interpolate, 0 for no limit.")
+    parser.add_argument('--fill-long-gaps', action='store_true',
+                        help="Interpolate the gaps longer than the limits anyway (only count them).")
+    parser.add_argument('--explode', action='store_true', help="Explode the multipart lines.")
+    parser.add_argument('--layer', help="Layer to process in each file, the first one if not given.")
+    parser.add_argument('--driver', help="OGR driver of the output files, the input one if not given.")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes.")
+    parser.add_argument('--chunk-size', type=int, default=1000, help="Number of lines read per chunk.")
+    parser.add_argument('--overwrite', action='store_true',
+                        help="Replace the existing output files (eg. when re-running on the same files).")
+    args = parser.parse_args(argv)
+
+    try:
+        nodataz = parse_nodataz_values(args.nodataz)
+    except ValueError:
+        parser.error("--nodataz must be numbers (or nan) separated by commas.")
+    if not nodataz:
+        parser.error("--nodataz requires at least one value.")
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    n_failed = 0
+    with contextlib.ExitStack() as stack:
+        executor = None
+        # Processes rather than threads, the interpolation of typical lines
+        # (hundreds of vertices) being mostly Python code holding the GIL.
+        if args.workers > 1:
+            executor = stack.enter_context(concurrent.futures.ProcessPoolExecutor(max_workers=args.workers))
+        for input_path in args.inputs:
+            output_path = os.path.join(args.output_dir, os.path.basename(input_path))
+            if os.path.abspath(output_path) == os.path.abspath(input_path):
+                parser.error("--output-dir must differ from the directory of the input files.")
+            try:
+                report = interpolate_missing_z_file(
+                    input_path, output_path, nodataz, args.nodataz_tolerance, args.engine,
+                    args.explode, args.layer, args.driver, executor, args.workers, args.chunk_size,
+                    (args.max_gap_distance, args.max_gap_vertices), args.fill_long_gaps, args.overwrite
+                )
+            except (RuntimeError, ValueError) as error:
+                # OGR raises RuntimeError.
+                n_failed += 1
+                print("{}: {}".format(input_path, error), file=sys.stderr)
+                continue
+            print("{}: {} line(s), {}".format(
+                input_path, report.n_lines,
+                ', '.join('{} {}'.format(report.counts[category], category.replace('_', ' '))
+                          for category in report.CATEGORIES)
+            ))
+    return 1 if n_failed else 0
 
 
+if __name__ == '__main__':
+    sys.exit(main())